@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Concurrent login latency benchmark
+
+Fires a burst of simultaneous logins at the app in-process while a probe
+keeps requesting /api/profile, once with bcrypt called inline on the event
+loop (the old behaviour) and once through the password hash pool. The probe
+latency shows how long other requests are stalled by hashing.
+
+    python backend/benchmarks/bench_login.py --logins 32 --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "max_ms": max(latencies) if latencies else None,
+    }
+
+class InlineHasher:
+    """The pre-pool behaviour: bcrypt runs directly on the event loop."""
+
+    def __init__(self, server):
+        self.server = server
+
+    async def hash(self, password):
+        return self.server.get_password_hash(password)
+
+    async def verify(self, plain_password, hashed_password):
+        return self.server.verify_password(plain_password, hashed_password)
+
+    def stats(self):
+        return {}
+
+async def timed(coro):
+    start = time.perf_counter()
+    response = await coro
+    response.raise_for_status()
+    return (time.perf_counter() - start) * 1000
+
+async def run_mode(server, client, mode, logins, workers, credentials, token):
+    server.password_hasher = InlineHasher(server) if mode == "inline" else server.PasswordHashPool(workers)
+
+    done = asyncio.Event()
+    probe_latencies = []
+
+    async def probe():
+        while not done.is_set():
+            probe_latencies.append(await timed(client.get("/api/profile", params={"token": token})))
+            await asyncio.sleep(0.005)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    login_latencies = await asyncio.gather(*[
+        timed(client.post("/api/login", json=credentials)) for _ in range(logins)
+    ])
+    wall = time.perf_counter() - start
+    done.set()
+    await probe_task
+
+    return {
+        "mode": mode,
+        "wall_s": wall,
+        "logins_per_s": logins / wall,
+        "login": summarize(login_latencies),
+        "probe": summarize(probe_latencies),
+        "hasher": server.password_hasher.stats(),
+    }
+
+async def run(server, logins, workers):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        credentials = {"email": "bench@example.com", "password": "bench-password"}
+        response = await client.post("/api/register", json={"username": "bench", **credentials})
+        response.raise_for_status()
+        token = response.json()["token"]
+        return [await run_mode(server, client, mode, logins, workers, credentials, token) for mode in ("inline", "pool")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=32, help="simultaneous logins per run")
+    parser.add_argument("--workers", type=int, default=4, help="password hash pool size")
+    args = parser.parse_args()
+
+    # server.py opens ./messenger.db, so run against a throwaway directory
+    os.chdir(tempfile.mkdtemp(prefix="messenger-bench-"))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    server.run_migrations()
+
+    print(json.dumps(asyncio.run(run(server, args.logins, args.workers)), indent=2))
+
+if __name__ == "__main__":
+    main()
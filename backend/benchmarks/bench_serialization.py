@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Per-row response serialization benchmark
+
+Seeds one conversation with many messages, then encodes all of it the way
+the message endpoints used to and the way they do now:
+
+    orm_jsonable    ORM objects -> serialize_message() -> jsonable_encoder -> json.dumps
+    tuples_orjson   column tuples -> row._asdict() -> orjson.dumps
+    stream_orjson   column tuples fetched with yield_per, encoded batch by batch (NDJSON)
+
+Each mode is timed for fetching and for encoding separately (best of
+--repeat runs) and reported per row, along with the peak Python memory of
+one extra traced run.
+
+    python backend/benchmarks/bench_serialization.py --messages 100000 --repeat 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import insert, or_, select
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SEED_BATCH = 1000
+
+async def seed_conversation(server, message_count):
+    now = datetime.utcnow()
+    alice, bob = str(uuid.uuid4()), str(uuid.uuid4())
+    start = now - timedelta(seconds=message_count)
+    async with server.AsyncSessionLocal() as db:
+        await db.execute(insert(server.User), [
+            {"id": user_id, "username": name, "email": f"{name}@bench.local", "password": "-",
+             "last_online": now, "created_at": now}
+            for user_id, name in ((alice, "alice"), (bob, "bob"))
+        ])
+        for offset in range(0, message_count, SEED_BATCH):
+            await db.execute(insert(server.Message), [
+                {
+                    "id": str(uuid.uuid4()),
+                    "sender_id": alice if seq % 2 else bob,
+                    "receiver_id": bob if seq % 2 else alice,
+                    "text": f"seed message {seq} with a little more text to look like a chat line",
+                    "timestamp": start + timedelta(seconds=seq),
+                    "is_read": True,
+                    "seq": seq,
+                }
+                for seq in range(offset + 1, min(offset + SEED_BATCH, message_count) + 1)
+            ])
+        await db.commit()
+    return alice, bob
+
+def conversation(server, columns, alice, bob):
+    Message = server.Message
+    return select(*columns).where(or_(
+        (Message.sender_id == alice) & (Message.receiver_id == bob),
+        (Message.sender_id == bob) & (Message.receiver_id == alice),
+    )).order_by(Message.timestamp, Message.id)
+
+def encode_like_json_response(content):
+    # What JSONResponse.render() did with the jsonable_encoder output
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+async def orm_jsonable(server, alice, bob):
+    async with server.AsyncSessionLocal() as db:
+        start = time.perf_counter()
+        messages = (await db.scalars(conversation(server, (server.Message,), alice, bob))).all()
+        fetched = time.perf_counter()
+        body = encode_like_json_response(jsonable_encoder({"messages": [server.serialize_message(m) for m in messages]}))
+        return len(messages), fetched - start, time.perf_counter() - fetched, len(body)
+
+async def tuples_orjson(server, alice, bob):
+    async with server.AsyncSessionLocal() as db:
+        start = time.perf_counter()
+        rows = (await db.execute(conversation(server, server.MESSAGE_COLUMNS, alice, bob))).all()
+        fetched = time.perf_counter()
+        body = orjson.dumps({"messages": [row._asdict() for row in rows]})
+        return len(rows), fetched - start, time.perf_counter() - fetched, len(body)
+
+async def stream_orjson(server, alice, bob):
+    count = size = 0
+    fetch = encode = 0.0
+    async with server.AsyncSessionLocal() as db:
+        query = conversation(server, server.MESSAGE_COLUMNS, alice, bob)
+        start = time.perf_counter()
+        result = await db.stream(query.execution_options(yield_per=server.STREAM_BATCH_SIZE))
+        partitions = result.partitions()
+        while True:
+            try:
+                rows = await partitions.__anext__()
+            except StopAsyncIteration:
+                break
+            fetched = time.perf_counter()
+            fetch += fetched - start
+            size += len(b"".join(orjson.dumps(row._asdict()) + b"\n" for row in rows))
+            count += len(rows)
+            start = time.perf_counter()
+            encode += start - fetched
+        fetch += time.perf_counter() - start
+    return count, fetch, encode, size
+
+MODES = {
+    "orm_jsonable": orm_jsonable,
+    "tuples_orjson": tuples_orjson,
+    "stream_orjson": stream_orjson,
+}
+
+async def measure(server, mode, alice, bob, repeat):
+    best = None
+    for _ in range(repeat):
+        rows, fetch, encode, size = await mode(server, alice, bob)
+        if best is None or fetch + encode < best[1] + best[2]:
+            best = (rows, fetch, encode, size)
+    rows, fetch, encode, size = best
+
+    tracemalloc.start()
+    await mode(server, alice, bob)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "rows": rows,
+        "bytes": size,
+        "fetch_us_per_row": fetch / rows * 1e6,
+        "encode_us_per_row": encode / rows * 1e6,
+        "total_us_per_row": (fetch + encode) / rows * 1e6,
+        "peak_traced_mib": peak / 2**20,
+    }
+
+async def run(server, args):
+    start = time.perf_counter()
+    alice, bob = await seed_conversation(server, args.messages)
+    seed_seconds = time.perf_counter() - start
+    results = {name: await measure(server, MODES[name], alice, bob, args.repeat) for name in args.modes.split(",")}
+    await server.async_engine.dispose()
+    return {"messages": args.messages, "repeat": args.repeat, "seed_seconds": seed_seconds, "modes": results}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100000, help="messages in the seeded conversation")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per mode; the fastest is reported")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma-separated subset of modes")
+    args = parser.parse_args()
+    unknown = [name for name in args.modes.split(",") if name not in MODES]
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(unknown)}")
+
+    # server.py opens ./messenger.db, so run against a throwaway directory
+    os.chdir(tempfile.mkdtemp(prefix="messenger-bench-"))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    server.run_migrations()
+
+    print(json.dumps(asyncio.run(run(server, args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Messenger API benchmark suite
+
+Boots the app in-process against a fresh database in a temporary directory,
+seeds users and messages straight into the database, then runs each scenario
+with a fixed number of requests spread over concurrent clients:
+
+    login_storm     POST /api/login
+    chat_polling    conversation list, message pages, delta sync and unread counts
+    send_burst      POST /api/messages
+    search          GET /api/users/search
+    message_search  GET /api/search/messages
+    favorites       POST and GET /api/favorites
+    uploads         POST /api/upload
+
+Results (p50/p95/p99 latency, requests/sec, errors) are printed as JSON along
+with the commit and settings, so runs can be saved and compared across commits.
+
+    python backend/benchmarks/bench_suite.py --users 200 --messages 20000 --output before.json
+    python backend/benchmarks/bench_suite.py --scenarios send_burst,search --concurrency 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+from sqlalchemy import insert, update
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+PASSWORD = "bench-password"
+SEED_BATCH = 1000
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(latencies, errors, wall):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "wall_s": wall,
+        "requests_per_s": len(latencies) / wall if wall else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies) if latencies else None,
+    }
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Seed:
+    """What the scenarios need to know about the seeded data."""
+
+    def __init__(self, users, pairs, sync_cursor):
+        # [(user_id, username, email, token)]
+        self.users = users
+        # Conversations that have history, as (user index, peer index)
+        self.pairs = pairs
+        self.sync_cursor = sync_cursor
+
+async def seed_database(server, user_count, message_count, rng):
+    password = server.get_password_hash(PASSWORD)
+    now = datetime.utcnow()
+    users = []
+    user_rows = []
+    for i in range(user_count):
+        user_id = str(uuid.uuid4())
+        username, email = f"user{i:05d}", f"user{i:05d}@bench.local"
+        users.append((user_id, username, email, server.create_access_token(user_id)))
+        user_rows.append({
+            "id": user_id, "username": username, "email": email, "password": password,
+            "last_online": now, "created_at": now,
+        })
+
+    # Messages go oldest first, so seq order matches timestamp order
+    start = now - timedelta(seconds=message_count)
+    message_rows = []
+    conversations = {}
+    for seq in range(1, message_count + 1):
+        sender, receiver = rng.sample(range(user_count), 2)
+        message = {
+            "id": str(uuid.uuid4()),
+            "sender_id": users[sender][0],
+            "receiver_id": users[receiver][0],
+            "text": f"seed message {seq}",
+            "timestamp": start + timedelta(seconds=seq),
+            "is_read": rng.random() < 0.8,
+            "seq": seq,
+        }
+        message_rows.append(message)
+        for owner, peer in ((sender, receiver), (receiver, sender)):
+            row = conversations.setdefault((owner, peer), {
+                "user_id": users[owner][0], "peer_id": users[peer][0], "unread_count": 0,
+            })
+            row.update(
+                last_message_id=message["id"], last_sender_id=message["sender_id"],
+                last_message_text=message["text"], last_timestamp=message["timestamp"],
+            )
+            if owner == receiver and not message["is_read"]:
+                row["unread_count"] += 1
+
+    async with server.AsyncSessionLocal() as db:
+        for model, rows in (
+            (server.User, user_rows),
+            (server.Message, message_rows),
+            (server.Conversation, list(conversations.values())),
+        ):
+            for i in range(0, len(rows), SEED_BATCH):
+                await db.execute(insert(model), rows[i:i + SEED_BATCH])
+        await db.execute(
+            update(server.SyncCounter).where(server.SyncCounter.name == "messages").values(value=message_count)
+        )
+        await db.commit()
+
+    return Seed(users, list(conversations), message_count)
+
+# Each scenario makes one request and returns the response
+
+async def login_storm(client, seed, rng):
+    _, _, email, _ = rng.choice(seed.users)
+    return await client.post("/api/login", json={"email": email, "password": PASSWORD})
+
+async def chat_polling(client, seed, rng):
+    owner, peer = rng.choice(seed.pairs)
+    token = seed.users[owner][3]
+    kind = rng.randrange(4)
+    if kind == 0:
+        return await client.get("/api/conversations", params={"token": token})
+    if kind == 1:
+        return await client.get(f"/api/messages/{seed.users[peer][0]}", params={"token": token, "limit": 50})
+    if kind == 2:
+        since = max(0, seed.sync_cursor - rng.randrange(1, 200))
+        return await client.get("/api/sync", params={"token": token, "since": since})
+    return await client.get("/api/unread_counts", params={"token": token})
+
+async def send_burst(client, seed, rng):
+    sender, receiver = rng.sample(seed.users, 2)
+    return await client.post("/api/messages", params={"token": sender[3]}, json={
+        "receiver_id": receiver[0], "text": f"burst {rng.random()}"
+    })
+
+async def search(client, seed, rng):
+    _, username, _, _ = rng.choice(seed.users)
+    token = rng.choice(seed.users)[3]
+    # Mix short prefixes with trigram-sized substrings
+    length = rng.choice((2, 3, 4, 5))
+    offset = rng.randrange(len(username) - length + 1)
+    return await client.get("/api/users/search", params={"token": token, "q": username[offset:offset + length]})
+
+async def message_search(client, seed, rng):
+    owner, peer = rng.choice(seed.pairs)
+    params = {"token": seed.users[owner][3], "q": f"message {rng.randrange(1, 100)}"}
+    if rng.random() < 0.5:
+        params["peer_id"] = seed.users[peer][0]
+    return await client.get("/api/search/messages", params=params)
+
+async def favorites(client, seed, rng):
+    token = rng.choice(seed.users)[3]
+    if rng.random() < 0.5:
+        return await client.post("/api/favorites", params={"token": token}, json={"text": f"favorite {rng.random()}"})
+    return await client.get("/api/favorites", params={"token": token})
+
+def uploads(upload_size):
+    async def scenario(client, seed, rng):
+        token = rng.choice(seed.users)[3]
+        return await client.post("/api/upload", params={"token": token}, files={
+            "file": ("bench.bin", rng.randbytes(upload_size), "application/octet-stream")
+        })
+    return scenario
+
+async def run_scenario(client, seed, scenario, requests, concurrency, rng):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await scenario(client, seed, rng)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+async def run(server, args):
+    rng = random.Random(args.seed)
+    scenarios = {
+        "login_storm": login_storm,
+        "chat_polling": chat_polling,
+        "send_burst": send_burst,
+        "search": search,
+        "message_search": message_search,
+        "favorites": favorites,
+        "uploads": uploads(args.upload_size),
+    }
+    selected = args.scenarios.split(",") if args.scenarios else list(scenarios)
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    # ASGITransport doesn't send lifespan events, so run startup (migrations, pub/sub) here
+    await server.app.router.startup()
+    try:
+        start = time.perf_counter()
+        seed = await seed_database(server, args.users, args.messages, rng)
+        seed_seconds = time.perf_counter() - start
+
+        results = {}
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in selected:
+                requests = args.login_requests if name == "login_storm" else args.requests
+                results[name] = await run_scenario(client, seed, scenarios[name], requests, args.concurrency, rng)
+    finally:
+        await server.app.router.shutdown()
+
+    return {
+        "commit": current_commit(),
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "settings": {
+            "users": args.users,
+            "messages": args.messages,
+            "requests": args.requests,
+            "login_requests": args.login_requests,
+            "concurrency": args.concurrency,
+            "upload_size": args.upload_size,
+            "seed": args.seed,
+            "sqlite_mode": os.environ.get("SQLITE_MODE", "default"),
+            "rate_limits": args.rate_limits,
+        },
+        "seed_seconds": seed_seconds,
+        "scenarios": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="users to seed")
+    parser.add_argument("--messages", type=int, default=10000, help="messages to seed")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=100, help="requests for login_storm, which is bcrypt-bound")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients per scenario")
+    parser.add_argument("--upload-size", type=int, default=64 * 1024, help="bytes per upload")
+    parser.add_argument("--scenarios", help="comma-separated subset to run (default: all)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for data and request mix")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the per-user write rate limits on")
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error("--users must be at least 2")
+
+    if not args.rate_limits:
+        # A few seeded users make every request, far more than real clients would
+        for name in ("RATE_LIMIT_MESSAGES", "RATE_LIMIT_FAVORITES", "RATE_LIMIT_UPLOADS"):
+            os.environ.setdefault(name, "0,0")
+
+    # server.py opens ./messenger.db, so run against a throwaway directory, uploads included
+    os.chdir(tempfile.mkdtemp(prefix="messenger-bench-"))
+    os.environ["UPLOAD_DIR"] = os.path.abspath("uploads")
+    os.environ["PARTIAL_UPLOAD_DIR"] = os.path.abspath("partial_uploads")
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    report = json.dumps(asyncio.run(run(server, args)), indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Concurrent write throughput benchmark
+
+Runs many simultaneous senders against the app in-process, each posting
+messages as fast as it gets responses, once with the default SQLite setup and
+once with SQLITE_MODE=production (WAL, synchronous=NORMAL, single writer with
+group commit). A reader keeps loading the conversation meanwhile, to show
+whether reads stall behind the writes. Each mode runs in its own process,
+since the mode is fixed when server.py is imported.
+
+    python backend/benchmarks/bench_writes.py --senders 32 --messages 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+MODES = ("default", "production")
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "max_ms": max(latencies) if latencies else None,
+    }
+
+async def timed(coro):
+    start = time.perf_counter()
+    response = await coro
+    response.raise_for_status()
+    return (time.perf_counter() - start) * 1000
+
+async def register(client, name):
+    response = await client.post("/api/register", json={
+        "username": name, "email": f"{name}@example.com", "password": "bench-password"
+    })
+    response.raise_for_status()
+    return response.json()
+
+async def run(server, mode, senders, messages):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        receiver = await register(client, "receiver")
+        tokens = [(await register(client, f"sender{i}"))["token"] for i in range(senders)]
+
+        async def sender(token):
+            return [
+                await timed(client.post("/api/messages", params={"token": token}, json={
+                    "receiver_id": receiver["user_id"], "text": f"message {i}"
+                }))
+                for i in range(messages)
+            ]
+
+        done = asyncio.Event()
+        read_latencies = []
+
+        async def reader():
+            while not done.is_set():
+                read_latencies.append(await timed(client.get("/api/unread_counts", params={"token": receiver["token"]})))
+                await asyncio.sleep(0.005)
+
+        reader_task = asyncio.create_task(reader())
+        start = time.perf_counter()
+        per_sender = await asyncio.gather(*[sender(token) for token in tokens])
+        wall = time.perf_counter() - start
+        done.set()
+        await reader_task
+
+        writes = [latency for latencies in per_sender for latency in latencies]
+        status = (await client.get("/api/status", params={"token": receiver["token"]})).json()
+        if server.db_writer is not None:
+            await server.db_writer.stop()
+
+    return {
+        "mode": mode,
+        "wall_s": wall,
+        "messages_per_s": len(writes) / wall,
+        "write": summarize(writes),
+        "read": summarize(read_latencies),
+        "database_writer": status.get("database_writer"),
+    }
+
+def run_mode(mode, senders, messages):
+    # server.py opens ./messenger.db, so run against a throwaway directory
+    os.chdir(tempfile.mkdtemp(prefix="messenger-bench-"))
+    os.environ["SQLITE_MODE"] = mode
+    # Senders post back to back, far past the per-user message rate limit
+    os.environ.setdefault("RATE_LIMIT_MESSAGES", "0,0")
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    server.run_migrations()
+
+    return asyncio.run(run(server, mode, senders, messages))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--senders", type=int, default=32, help="concurrent senders")
+    parser.add_argument("--messages", type=int, default=50, help="messages per sender")
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.senders, args.messages)))
+        return
+
+    results = []
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--senders", str(args.senders), "--messages", str(args.messages)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
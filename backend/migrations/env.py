@@ -0,0 +1,50 @@
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+
+from server import Base
+
+config = context.config
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+# Objects the migrations create with raw DDL rather than through the models
+UNMODELLED_PREFIXES = ("user_search", "ix_users_username_", "message_search", "ix_messages_text_search")
+
+def include_object(obj, name, type_, reflected, compare_to):
+    return not (reflected and compare_to is None and name.startswith(UNMODELLED_PREFIXES))
+
+def database_url():
+    return config.get_main_option("sqlalchemy.url") or os.environ.get(
+        "SQLALCHEMY_DATABASE_URL", "sqlite:///./messenger.db"
+    )
+
+def run_migrations_offline():
+    """Emit the migration SQL to stdout instead of running it (alembic upgrade --sql)."""
+    context.configure(url=database_url(), target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online():
+    # The server hands over its own connection; the CLI opens one
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object, render_as_batch=True)
+        with context.begin_transaction():
+            context.run_migrations()
+        return
+
+    engine = create_engine(database_url())
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object, render_as_batch=True)
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,182 @@
+"""Initial schema
+
+Creates the tables on an empty database. A database made by a build from
+before migrations (create_all at import time) is adopted instead: missing
+tables, columns and indexes are added and older rows are backfilled, so both
+end up at the same schema.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def table_columns():
+    return {
+        "users": [
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("username", sa.String()),
+            sa.Column("email", sa.String()),
+            sa.Column("password", sa.String()),
+            sa.Column("avatar", sa.String(), nullable=True),
+            sa.Column("avatar_thumbnails", sa.JSON(none_as_null=True), nullable=True),
+            sa.Column("last_online", sa.DateTime()),
+            sa.Column("created_at", sa.DateTime()),
+            sa.Column("invisible_mode", sa.Boolean()),
+            sa.Column("hide_last_seen", sa.Boolean()),
+            sa.Column("hide_profile_info", sa.Boolean()),
+            sa.Column("theme", sa.String()),
+            sa.Column("custom_primary_color", sa.String()),
+            sa.Column("custom_secondary_color", sa.String()),
+        ],
+        "messages": [
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("sender_id", sa.String(), sa.ForeignKey("users.id")),
+            sa.Column("receiver_id", sa.String(), sa.ForeignKey("users.id")),
+            sa.Column("text", sa.Text()),
+            sa.Column("timestamp", sa.DateTime()),
+            sa.Column("is_read", sa.Boolean()),
+            sa.Column("seq", sa.Integer()),
+        ],
+        "favorite_messages": [
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("user_id", sa.String(), sa.ForeignKey("users.id")),
+            sa.Column("type", sa.String()),
+            sa.Column("text", sa.Text(), nullable=True),
+            sa.Column("file_url", sa.String(), nullable=True),
+            sa.Column("voice_url", sa.String(), nullable=True),
+            sa.Column("timestamp", sa.DateTime()),
+            sa.Column("orig", sa.JSON(none_as_null=True), nullable=True),
+        ],
+        "sync_counters": [
+            sa.Column("name", sa.String(), primary_key=True),
+            sa.Column("value", sa.Integer()),
+        ],
+    }
+
+
+def table_indexes():
+    unread = sa.column("is_read", sa.Boolean()) == False
+    return [
+        ("ix_users_username", "users", ["username"], {"unique": True}),
+        ("ix_users_email", "users", ["email"], {"unique": True}),
+        ("ix_messages_seq", "messages", ["seq"], {"unique": True}),
+        ("ix_messages_conversation", "messages", ["sender_id", "receiver_id", "timestamp"], {}),
+        ("ix_messages_sender_seq", "messages", ["sender_id", "seq"], {}),
+        ("ix_messages_receiver_seq", "messages", ["receiver_id", "seq"], {}),
+        ("ix_messages_unread", "messages", ["receiver_id", "sender_id"], {"sqlite_where": unread, "postgresql_where": unread}),
+        ("ix_favorite_messages_user_timestamp", "favorite_messages", ["user_id", "timestamp", "id"], {}),
+    ]
+
+
+# Username search. SQLite: a trigram FTS5 table answers substring queries and
+# a NOCASE index answers prefix queries too short to form a trigram.
+# PostgreSQL: a pg_trgm GIN index serves ILIKE, a lower() index serves prefixes.
+SQLITE_USER_SEARCH = [
+    "CREATE INDEX IF NOT EXISTS ix_users_username_nocase ON users (username COLLATE NOCASE)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(username, user_id UNINDEXED, tokenize='trigram')",
+    """CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+        INSERT INTO user_search (username, user_id) VALUES (new.username, new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username ON users BEGIN
+        UPDATE user_search SET username = new.username WHERE user_id = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+        DELETE FROM user_search WHERE user_id = old.id;
+    END""",
+]
+
+POSTGRESQL_USER_SEARCH = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username) text_pattern_ops)",
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    offline = op.get_context().as_sql
+    inspector = None if offline else sa.inspect(bind)
+    legacy = not offline and inspector.has_table("users")
+
+    existing_indexes = set()
+    for table_name, columns in table_columns().items():
+        if not legacy or not inspector.has_table(table_name):
+            op.create_table(table_name, *columns)
+            continue
+        # Left by an older build: add whatever columns it predates
+        existing = {c["name"] for c in inspector.get_columns(table_name)}
+        for column in columns:
+            if column.name not in existing:
+                op.add_column(table_name, column)
+        existing_indexes.update(index["name"] for index in inspector.get_indexes(table_name))
+
+    if legacy and isinstance(next(c["type"] for c in inspector.get_columns("favorite_messages") if c["name"] == "orig"), sa.Text):
+        # orig used to be a Text column holding json.dumps output; the stored text is unchanged
+        with op.batch_alter_table("favorite_messages") as batch:
+            batch.alter_column("orig", type_=sa.JSON(none_as_null=True), existing_type=sa.Text(), existing_nullable=True)
+
+    for name, table_name, columns, options in table_indexes():
+        if name not in existing_indexes:
+            op.create_index(name, table_name, columns, **options)
+
+    messages = sa.table(
+        "messages", sa.column("id", sa.String()), sa.column("timestamp", sa.DateTime()), sa.column("seq", sa.Integer())
+    )
+    sync_counters = sa.table("sync_counters", sa.column("name", sa.String()), sa.column("value", sa.Integer()))
+    last_seq = 0
+    if legacy:
+        if bind.dialect.name == "sqlite":
+            # Older rows were stamped by func.now() without microseconds; pad them
+            # so they compare correctly against cursor values bound from Python
+            for table_name in ("messages", "favorite_messages"):
+                op.execute(f"UPDATE {table_name} SET timestamp = timestamp || '.000000' WHERE length(timestamp) = 19")
+
+        # Give pre-existing messages a place in the change feed, oldest first
+        last_seq = bind.execute(sa.select(sa.func.coalesce(sa.func.max(messages.c.seq), 0))).scalar()
+        unsequenced = bind.execute(
+            sa.select(messages.c.id).where(messages.c.seq.is_(None)).order_by(messages.c.timestamp, messages.c.id)
+        ).scalars().all()
+        if unsequenced:
+            bind.execute(
+                messages.update().where(messages.c.id == sa.bindparam("message_id")).values(seq=sa.bindparam("new_seq")),
+                [{"message_id": message_id, "new_seq": last_seq + i} for i, message_id in enumerate(unsequenced, 1)]
+            )
+            last_seq += len(unsequenced)
+        if bind.execute(sa.select(sync_counters.c.value).where(sync_counters.c.name == "messages")).first() is not None:
+            last_seq = None
+    if last_seq is not None:
+        op.bulk_insert(sync_counters, [{"name": "messages", "value": last_seq}])
+
+    if bind.dialect.name == "sqlite":
+        search_exists = legacy and inspector.has_table("user_search")
+        for statement in SQLITE_USER_SEARCH:
+            op.execute(statement)
+        if not search_exists:
+            op.execute("INSERT INTO user_search (username, user_id) SELECT username, id FROM users")
+    elif bind.dialect.name == "postgresql":
+        for statement in POSTGRESQL_USER_SEARCH:
+            op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == "sqlite":
+        for trigger in ("users_search_insert", "users_search_update", "users_search_delete"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS user_search")
+    for table_name in reversed(list(table_columns())):
+        op.drop_table(table_name)
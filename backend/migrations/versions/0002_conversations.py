@@ -0,0 +1,67 @@
+"""Conversations inbox
+
+Adds one row per side of every conversation with the last message and the
+unread count, and fills it from the existing messages.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PREVIEW_LENGTH = 200
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "conversations",
+        sa.Column("user_id", sa.String(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("peer_id", sa.String(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("last_message_id", sa.String()),
+        sa.Column("last_sender_id", sa.String()),
+        sa.Column("last_message_text", sa.Text()),
+        sa.Column("last_timestamp", sa.DateTime()),
+        sa.Column("unread_count", sa.Integer()),
+    )
+    op.create_index("ix_conversations_user_recent", "conversations", ["user_id", "last_timestamp", "peer_id"])
+
+    # Each message belongs to its sender's and its receiver's row; keep the
+    # newest per row and count what the owner hasn't read
+    op.execute(f"""
+        INSERT INTO conversations
+            (user_id, peer_id, last_message_id, last_sender_id, last_message_text, last_timestamp, unread_count)
+        SELECT owner_id, peer_id, id, sender_id, substr(text, 1, {PREVIEW_LENGTH}), timestamp,
+            (SELECT count(*) FROM messages u
+             WHERE u.receiver_id = ranked.owner_id AND u.sender_id = ranked.peer_id
+               AND u.sender_id != u.receiver_id AND NOT u.is_read)
+        FROM (
+            SELECT sides.*, row_number() OVER (
+                PARTITION BY owner_id, peer_id ORDER BY timestamp DESC, id DESC
+            ) AS position
+            FROM (
+                SELECT id, sender_id, text, timestamp, sender_id AS owner_id, receiver_id AS peer_id FROM messages
+                UNION ALL
+                SELECT id, sender_id, text, timestamp, receiver_id, sender_id FROM messages
+                WHERE receiver_id != sender_id
+            ) sides
+        ) ranked
+        WHERE position = 1
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_conversations_user_recent", table_name="conversations")
+    op.drop_table("conversations")
@@ -0,0 +1,65 @@
+"""Message full-text search
+
+SQLite: an FTS5 table mirrors message text, keyed by the messages rowid and
+kept in step by triggers. A participants column holds both user ids, so a
+search is narrowed to the caller's conversations inside the index rather than
+after it. PostgreSQL: a GIN index over to_tsvector('simple', text).
+
+Existing messages are not indexed here, so the migration stays quick on a
+large database; run tools/backfill_message_search.py once afterwards.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, Sequence[str], None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SQLITE_MESSAGE_SEARCH = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+        text, participants, tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO message_search (rowid, text, participants)
+        VALUES (new.rowid, new.text, replace(new.sender_id || ' ' || new.receiver_id, '-', ''));
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_search_update AFTER UPDATE OF text ON messages BEGIN
+        UPDATE message_search SET text = new.text WHERE rowid = old.rowid;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM message_search WHERE rowid = old.rowid;
+    END""",
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == "sqlite":
+        for statement in SQLITE_MESSAGE_SEARCH:
+            op.execute(statement)
+    elif dialect == "postgresql":
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_messages_text_search ON messages "
+            "USING gin (to_tsvector('simple', coalesce(text, '')))"
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    dialect = op.get_bind().dialect.name
+    if dialect == "sqlite":
+        for trigger in ("messages_search_insert", "messages_search_update", "messages_search_delete"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS message_search")
+    elif dialect == "postgresql":
+        op.execute("DROP INDEX IF EXISTS ix_messages_text_search")
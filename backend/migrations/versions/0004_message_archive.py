@@ -0,0 +1,49 @@
+"""Message archive index
+
+One row per compressed block of archived messages. The blocks themselves
+live in per-conversation segment files under MESSAGE_ARCHIVE_DIR and are
+written by tools/archive_messages.py.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "archive_segments",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_low", sa.String(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("user_high", sa.String(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("file", sa.String(), nullable=False),
+        sa.Column("offset", sa.BigInteger(), nullable=False),
+        sa.Column("length", sa.Integer(), nullable=False),
+        sa.Column("message_count", sa.Integer(), nullable=False),
+        sa.Column("first_timestamp", sa.DateTime(), nullable=False),
+        sa.Column("first_id", sa.String(), nullable=False),
+        sa.Column("last_timestamp", sa.DateTime(), nullable=False),
+        sa.Column("last_id", sa.String(), nullable=False),
+    )
+    op.create_index(
+        "ix_archive_segments_conversation", "archive_segments", ["user_low", "user_high", "first_timestamp"]
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_archive_segments_conversation", table_name="archive_segments")
+    op.drop_table("archive_segments")
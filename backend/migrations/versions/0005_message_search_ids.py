@@ -0,0 +1,111 @@
+"""Key message search on message ids
+
+0003 keyed message_search on the messages rowid. messages has a TEXT
+primary key, so that rowid is implicit and VACUUM may renumber it, leaving
+the index pointing at other messages. Each indexed message now gets a docid
+in message_search_keys, whose INTEGER PRIMARY KEY is stable, and the FTS5
+row stores the message id itself as an UNINDEXED column.
+
+SQLite only. FTS5 can't add a column, so the old index is dropped and the
+new one is filled from the messages table here, in the migration's
+transaction: the server migrates on startup, and search must not come up
+empty after an upgrade. That re-tokenizes every message, so on a large
+database the upgrade takes a while.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, Sequence[str], None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TRIGGERS = ("messages_search_insert", "messages_search_update", "messages_search_delete")
+
+SQLITE_MESSAGE_SEARCH = [
+    """CREATE TABLE message_search_keys (
+        docid INTEGER PRIMARY KEY,
+        message_id TEXT NOT NULL UNIQUE
+    )""",
+    """CREATE VIRTUAL TABLE message_search USING fts5(
+        message_id UNINDEXED, text, participants, tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER messages_search_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO message_search_keys (message_id) VALUES (new.id);
+        INSERT INTO message_search (rowid, message_id, text, participants)
+        VALUES (
+            (SELECT docid FROM message_search_keys WHERE message_id = new.id),
+            new.id, new.text, replace(new.sender_id || ' ' || new.receiver_id, '-', '')
+        );
+    END""",
+    """CREATE TRIGGER messages_search_update AFTER UPDATE OF text ON messages BEGIN
+        UPDATE message_search SET text = new.text
+        WHERE rowid = (SELECT docid FROM message_search_keys WHERE message_id = old.id);
+    END""",
+    """CREATE TRIGGER messages_search_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM message_search WHERE rowid = (SELECT docid FROM message_search_keys WHERE message_id = old.id);
+        DELETE FROM message_search_keys WHERE message_id = old.id;
+    END""",
+]
+
+# Index every message already in the table; keys first, in rowid order
+SQLITE_MESSAGE_SEARCH_FILL = [
+    "INSERT INTO message_search_keys (message_id) SELECT id FROM messages ORDER BY rowid",
+    """INSERT INTO message_search (rowid, message_id, text, participants)
+    SELECT k.docid, m.id, m.text, replace(m.sender_id || ' ' || m.receiver_id, '-', '')
+    FROM message_search_keys k JOIN messages m ON m.id = k.message_id""",
+]
+
+# 0003's rowid-keyed index, for downgrade
+SQLITE_ROWID_MESSAGE_SEARCH = [
+    """CREATE VIRTUAL TABLE message_search USING fts5(
+        text, participants, tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER messages_search_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO message_search (rowid, text, participants)
+        VALUES (new.rowid, new.text, replace(new.sender_id || ' ' || new.receiver_id, '-', ''));
+    END""",
+    """CREATE TRIGGER messages_search_update AFTER UPDATE OF text ON messages BEGIN
+        UPDATE message_search SET text = new.text WHERE rowid = old.rowid;
+    END""",
+    """CREATE TRIGGER messages_search_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM message_search WHERE rowid = old.rowid;
+    END""",
+]
+
+
+def drop_message_search() -> None:
+    for trigger in TRIGGERS:
+        op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    op.execute("DROP TABLE IF EXISTS message_search")
+    op.execute("DROP TABLE IF EXISTS message_search_keys")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    drop_message_search()
+    for statement in SQLITE_MESSAGE_SEARCH + SQLITE_MESSAGE_SEARCH_FILL:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    drop_message_search()
+    for statement in SQLITE_ROWID_MESSAGE_SEARCH:
+        op.execute(statement)
+    op.execute(
+        "INSERT INTO message_search (rowid, text, participants) "
+        "SELECT rowid, text, replace(sender_id || ' ' || receiver_id, '-', '') FROM messages"
+    )
@@ -0,0 +1,62 @@
+"""Keep archived messages in message search
+
+Archiving deletes messages from the table, and the delete trigger took
+their index rows with them. message_search_keys now records the archive
+segment a message moved to; archive_conversation sets it before deleting,
+the trigger leaves such rows alone, and search reads the message from its
+segment.
+
+SQLite only. Messages archived before this revision are already out of the
+index; tools/backfill_message_search.py indexes them again from the segment
+files.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, Sequence[str], None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ARCHIVE_AWARE_DELETE = """CREATE TRIGGER messages_search_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM message_search
+    WHERE rowid = (SELECT docid FROM message_search_keys WHERE message_id = old.id AND segment_id IS NULL);
+    DELETE FROM message_search_keys WHERE message_id = old.id AND segment_id IS NULL;
+END"""
+
+# 0005's trigger, for downgrade
+DELETE = """CREATE TRIGGER messages_search_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM message_search WHERE rowid = (SELECT docid FROM message_search_keys WHERE message_id = old.id);
+    DELETE FROM message_search_keys WHERE message_id = old.id;
+END"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    op.execute("ALTER TABLE message_search_keys ADD COLUMN segment_id INTEGER")
+    op.execute("DROP TRIGGER IF EXISTS messages_search_delete")
+    op.execute(ARCHIVE_AWARE_DELETE)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != "sqlite":
+        return
+    op.execute("DROP TRIGGER IF EXISTS messages_search_delete")
+    op.execute(DELETE)
+    op.execute(
+        "DELETE FROM message_search WHERE rowid IN "
+        "(SELECT docid FROM message_search_keys WHERE segment_id IS NOT NULL)"
+    )
+    op.execute("DELETE FROM message_search_keys WHERE segment_id IS NOT NULL")
+    op.execute("ALTER TABLE message_search_keys DROP COLUMN segment_id")
@@ -1,31 +1,117 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Query, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, FileResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey, func, Boolean
+from sqlalchemy import create_engine, event, Column, BigInteger, Integer, String, DateTime, Text, ForeignKey, func, Boolean, Index, text, tuple_, case, select, update, JSON, delete, bindparam, union_all
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import relationship
 from passlib.context import CryptContext
+from alembic import command as alembic_command
+from alembic.config import Config as AlembicConfig
+from PIL import Image, ImageOps, features
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+import jwt
+import orjson
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
 import os
-import shutil
+import asyncio
+import logging
 import time
 import json
+import base64
 import random
 import string
+import secrets
+import hashlib
+import re
+import html
+import gzip
+import brotli
+import mimetypes
+import io
+import math
+import contextlib
+import zipfile
+import mmap
+import threading
+import zlib
+import stat
+import fcntl
+import anyio
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# SQLite Database setup (for development)
-SQLALCHEMY_DATABASE_URL = "sqlite:///./messenger.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+logger = logging.getLogger(__name__)
+
+# Database setup: SQLite for development, any SQLAlchemy URL via SQLALCHEMY_DATABASE_URL
+SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL", "sqlite:///./messenger.db")
+
+def async_database_url(url):
+    """Map a sync database URL onto the matching asyncio driver."""
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+# SQLITE_MODE=production switches SQLite to WAL with relaxed fsync, sends
+# every write through one writer task (see DatabaseWriter) and keeps request
+# sessions on a read-only pool. Ignored for other databases.
+SQLITE_PRODUCTION_MODE = (
+    SQLALCHEMY_DATABASE_URL.startswith("sqlite") and os.environ.get("SQLITE_MODE", "default") == "production"
+)
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+
+def set_sqlite_pragmas(dbapi_connection, read_only):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def use_production_pragmas(sync_engine, read_only=False):
+    if SQLITE_PRODUCTION_MODE:
+        event.listen(sync_engine, "connect", lambda dbapi_connection, _: set_sqlite_pragmas(dbapi_connection, read_only))
+
+# The sync engine only runs migrations at startup; requests use async_engine
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False} if SQLALCHEMY_DATABASE_URL.startswith("sqlite") else {}
+)
+use_production_pragmas(engine)
+async_engine = create_async_engine(
+    async_database_url(SQLALCHEMY_DATABASE_URL),
+    pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+    max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+    pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+)
+use_production_pragmas(async_engine.sync_engine, read_only=True)
+# Rows stay readable after commit; reloading them would check a connection out again
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# The single connection the writer task commits through in production mode
+write_engine = create_async_engine(async_database_url(SQLALCHEMY_DATABASE_URL), pool_size=1, max_overflow=0)
+use_production_pragmas(write_engine.sync_engine)
+WriteSessionLocal = async_sessionmaker(write_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # Database Models
@@ -36,6 +122,8 @@ class User(Base):
     email = Column(String, unique=True, index=True)
     password = Column(String)
     avatar = Column(String, nullable=True)
+    # {size: url} of generated avatar thumbnails; None until they are ready
+    avatar_thumbnails = Column(JSON(none_as_null=True), nullable=True)
     last_online = Column(DateTime, default=func.now())
     created_at = Column(DateTime, default=func.now())
     # Privacy settings
@@ -53,8 +141,22 @@ class Message(Base):
     sender_id = Column(String, ForeignKey('users.id'))
     receiver_id = Column(String, ForeignKey('users.id'))
     text = Column(Text)
-    timestamp = Column(DateTime, default=func.now())
+    # Microsecond precision so (timestamp, id) keyset cursors rarely tie
+    timestamp = Column(DateTime, default=datetime.utcnow)
     is_read = Column(Boolean, default=False)
+    # Position in the global change feed; reassigned whenever the row changes
+    seq = Column(Integer, unique=True, index=True)
+
+    __table_args__ = (
+        Index('ix_messages_conversation', 'sender_id', 'receiver_id', 'timestamp'),
+        Index('ix_messages_sender_seq', 'sender_id', 'seq'),
+        Index('ix_messages_receiver_seq', 'receiver_id', 'seq'),
+        # Only unread rows are indexed, so unread counting never touches read history
+        Index(
+            'ix_messages_unread', 'receiver_id', 'sender_id',
+            sqlite_where=is_read == False, postgresql_where=is_read == False
+        ),
+    )
 
 class FavoriteMessage(Base):
     __tablename__ = 'favorite_messages'
@@ -64,11 +166,65 @@ class FavoriteMessage(Base):
     text = Column(Text, nullable=True)
     file_url = Column(String, nullable=True)
     voice_url = Column(String, nullable=True)
-    timestamp = Column(DateTime, default=func.now())
-    orig = Column(Text, nullable=True)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    # Stored as JSON and decoded by the driver layer; older rows hold the same json.dumps text
+    orig = Column(JSON(none_as_null=True), nullable=True)
+
+    __table_args__ = (
+        Index('ix_favorite_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+class SyncCounter(Base):
+    __tablename__ = 'sync_counters'
+    name = Column(String, primary_key=True)
+    value = Column(Integer, default=0)
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+class Conversation(Base):
+    """Inbox row for one side of a conversation, kept current by the message write path."""
+    __tablename__ = 'conversations'
+    user_id = Column(String, ForeignKey('users.id'), primary_key=True)
+    peer_id = Column(String, ForeignKey('users.id'), primary_key=True)
+    last_message_id = Column(String)
+    last_sender_id = Column(String)
+    # First CONVERSATION_PREVIEW_LENGTH characters of the last message
+    last_message_text = Column(Text)
+    last_timestamp = Column(DateTime)
+    unread_count = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index('ix_conversations_user_recent', 'user_id', 'last_timestamp', 'peer_id'),
+    )
+
+CONVERSATION_PREVIEW_LENGTH = 200
+
+class ArchiveSegment(Base):
+    """Index entry for one compressed block of archived messages (see archive_conversation)."""
+    __tablename__ = 'archive_segments'
+    id = Column(Integer, primary_key=True)
+    # The conversation's two participants, in sorted order
+    user_low = Column(String, ForeignKey('users.id'), nullable=False)
+    user_high = Column(String, ForeignKey('users.id'), nullable=False)
+    # Segment file, relative to MESSAGE_ARCHIVE_DIR, and the block's byte range in it
+    file = Column(String, nullable=False)
+    offset = Column(BigInteger, nullable=False)
+    length = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    first_timestamp = Column(DateTime, nullable=False)
+    first_id = Column(String, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    last_id = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index('ix_archive_segments_conversation', 'user_low', 'user_high', 'first_timestamp'),
+    )
+
+def run_migrations():
+    """Apply pending Alembic migrations (backend/migrations) to the configured database."""
+    config = AlembicConfig(str(ROOT_DIR / "alembic.ini"))
+    config.attributes["configure_logger"] = False
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        alembic_command.upgrade(config, "head")
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -79,25 +235,1738 @@ def get_password_hash(password):
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
-def get_db():
-    db = SessionLocal()
+class PasswordHashPool:
+    """Runs bcrypt in a bounded thread pool so a login burst can't stall the event loop.
+
+    bcrypt releases the GIL, so threads give real parallelism. At most
+    `max_workers` hashes run at once; the rest wait on the semaphore and are
+    counted in `waiting`.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self.semaphore = None
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.max_waiting = 0
+
+    async def _run(self, func, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self.semaphore.release()
+
+    async def hash(self, password):
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password, hashed_password):
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "waiting": self.waiting,
+            "active": self.active,
+            "completed": self.completed,
+            "max_waiting": self.max_waiting,
+        }
+
+password_hasher = PasswordHashPool(int(os.environ.get("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1))))
+
+# Session tokens
+JWT_SECRET = os.environ.get("JWT_SECRET")
+if not JWT_SECRET:
+    # Tokens then only survive until restart and only work within this worker
+    logger.warning("JWT_SECRET is not set; using a random per-process secret")
+    JWT_SECRET = secrets.token_urlsafe(32)
+JWT_ALGORITHM = "HS256"
+TOKEN_TTL = timedelta(hours=int(os.environ.get("TOKEN_TTL_HOURS", 24 * 7)))
+
+def create_access_token(user_id):
+    now = datetime.utcnow()
+    return jwt.encode({"sub": user_id, "iat": now, "exp": now + TOKEN_TTL}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def decode_access_token(token):
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])["sub"]
+    except (jwt.InvalidTokenError, KeyError):
+        raise HTTPException(status_code=401, detail="Недействительный токен")
+
+async def get_current_user_id(token: str = ""):
+    """Authenticate the `token` query parameter by its signature alone, without a query.
+
+    Async so it runs on the event loop: presence.touch must not race flush().
+    """
+    if not token:
+        raise HTTPException(status_code=401, detail="Нет токена")
+    user_id = decode_access_token(token)
+    presence.touch(user_id)
+    return user_id
+
+class UserCache:
+    """LRU cache of user records, each tagged with the profile version it was read at.
+
+    Every change to a user bumps its profile version (bump_profile_versions)
+    in the same transaction, so a record is current exactly while its tag
+    matches the stored version. No invalidation is needed, on this worker or
+    any other.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, user_id, version):
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] != version:
+            return None
+        self.entries.move_to_end(user_id)
+        return entry[1]
+
+    def put(self, user_id, version, record):
+        self.entries[user_id] = (version, record)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+user_cache = UserCache(maxsize=int(os.environ.get("USER_CACHE_SIZE", 10000)))
+
+async def load_user(db, user_id, version):
+    """Return the user's columns (minus the password hash) as a dict, or None.
+
+    `version` is the user's current profile version (load_version); the
+    cached record serves as long as it was read at that version.
+    """
+    record = user_cache.get(user_id, version)
+    if record is None:
+        user = await db.scalar(select(User).where(User.id == user_id))
+        if user is None:
+            return None
+        record = {c.name: getattr(user, c.name) for c in User.__table__.columns if c.name != "password"}
+        user_cache.put(user_id, version, record)
+    return record
+
+# Versions of the data behind conditional GETs. They are sync_counters rows
+# next to the message change feed, bumped in the transaction that changes the
+# data, so every worker builds the same ETag and a matching If-None-Match
+# means nothing behind the response has changed since.
+def version_key(scope, user_id=None):
+    # Scopes: "profile", "favorites" and "messages" of a user, and the shared "users" list
+    return scope if user_id is None else f"{scope}:{user_id}"
+
+async def bump_versions(db, *keys):
+    """Count a change to the data behind each key; the caller commits."""
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    # Sorted, so concurrent writers take the row locks in the same order
+    for key in sorted(set(keys)):
+        await db.execute(insert(SyncCounter).values(name=key, value=1).on_conflict_do_update(
+            index_elements=[SyncCounter.name], set_={"value": SyncCounter.value + 1}
+        ))
+
+async def bump_profile_versions(db, *user_ids):
+    # Profile changes also show in everyone's /users list
+    await bump_versions(db, version_key("users"), *(version_key("profile", user_id) for user_id in user_ids))
+
+async def load_version(db, key):
+    return await db.scalar(select(SyncCounter.value).where(SyncCounter.name == key)) or 0
+
+def version_tag(version):
+    return f'W/"{version}"'
+
+async def version_etag(db, key):
+    return version_tag(await load_version(db, key))
+
+def not_modified(request: Request, etag):
+    """A bare 304 if the client already holds `etag`, else None."""
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=revalidate_headers(etag))
+    return None
+
+def revalidate_headers(etag):
+    # Browsers keep the body but ask again every time
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+def serialize_message(m):
+    return {"id": m.id, "sender_id": m.sender_id, "receiver_id": m.receiver_id, "text": m.text, "timestamp": m.timestamp, "is_read": m.is_read, "seq": m.seq}
+
+# List endpoints select these as plain tuples; row._asdict() then matches serialize_message()
+MESSAGE_COLUMNS = (
+    Message.id, Message.sender_id, Message.receiver_id, Message.text, Message.timestamp, Message.is_read, Message.seq
+)
+FAVORITE_COLUMNS = (
+    FavoriteMessage.id, FavoriteMessage.type, FavoriteMessage.text, FavoriteMessage.file_url,
+    FavoriteMessage.voice_url, FavoriteMessage.timestamp, FavoriteMessage.orig
+)
+# Users who hide their last seen time, or go invisible, show no last_online to others
+visible_last_online = case(
+    (User.hide_last_seen | User.invisible_mode, None), else_=User.last_online
+).label("last_online")
+USER_LIST_COLUMNS = (User.id, User.username, User.avatar, User.avatar_thumbnails, visible_last_online)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 500))
+
+def wants_ndjson(request: Request):
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def stream_rows(query, key, ndjson, headers=None):
+    """Stream the rows of a column select as NDJSON, or as {key: [...]}, encoding
+    each batch as it is fetched instead of building the whole list first.
+
+    The body runs on its own session: request sessions are closed before a
+    streamed body is sent.
+    """
+    async def body():
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+            if ndjson:
+                async for rows in result.partitions():
+                    yield b"".join(orjson.dumps(row._asdict()) + b"\n" for row in rows)
+                return
+            yield b'{"' + key.encode() + b'":['
+            separator = b""
+            async for rows in result.partitions():
+                yield separator + b",".join(orjson.dumps(row._asdict()) for row in rows)
+                separator = b","
+            yield b"]}"
+
+    return StreamingResponse(body(), media_type=NDJSON_MEDIA_TYPE if ndjson else "application/json", headers=headers)
+
+async def allocate_seq(db, count=1):
+    """Reserve `count` consecutive change-feed positions and return the first.
+
+    The counter UPDATE takes the database write lock for the rest of the
+    transaction, so positions become visible to readers in allocation order.
+    """
+    await db.execute(
+        update(SyncCounter).where(SyncCounter.name == "messages").values(value=SyncCounter.value + count)
+    )
+    last = (await db.execute(select(SyncCounter.value).where(SyncCounter.name == "messages"))).scalar_one()
+    return last - count + 1
+
+async def record_conversation_message(db, message):
+    """Make `message` the latest in both participants' inbox rows and count it as unread for the receiver."""
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    last = {
+        "last_message_id": message.id,
+        "last_sender_id": message.sender_id,
+        "last_message_text": (message.text or "")[:CONVERSATION_PREVIEW_LENGTH],
+        "last_timestamp": message.timestamp,
+    }
+    sides = [(message.sender_id, message.receiver_id, 0)]
+    if message.receiver_id != message.sender_id:
+        sides.append((message.receiver_id, message.sender_id, 1))
+    for user_id, peer_id, unread in sides:
+        statement = insert(Conversation).values(user_id=user_id, peer_id=peer_id, unread_count=unread, **last)
+        await db.execute(statement.on_conflict_do_update(
+            index_elements=[Conversation.user_id, Conversation.peer_id],
+            set_={**last, "unread_count": Conversation.unread_count + unread},
+        ))
+    await bump_versions(db, version_key("messages", message.sender_id), version_key("messages", message.receiver_id))
+
+async def mark_conversation_read(db, reader_id, peer_id, up_to):
+    """Mark the peer's messages to `reader_id` at or before the (timestamp, id)
+    position `up_to` as read, giving each a new feed position.
+
+    Returns the ids of the messages that changed; the caller commits.
+    """
+    unread_ids = (await db.scalars(
+        select(Message.id).where(
+            (Message.sender_id == peer_id) & (Message.receiver_id == reader_id) & (Message.is_read == False) &
+            (tuple_(Message.timestamp, Message.id) <= up_to)
+        ).order_by(Message.timestamp, Message.id)
+    )).all()
+    if not unread_ids:
+        return []
+
+    first_seq = await allocate_seq(db, len(unread_ids))
+    await db.execute(
+        update(Message),
+        [{"id": message_id, "is_read": True, "seq": first_seq + i} for i, message_id in enumerate(unread_ids)]
+    )
+    await bump_versions(db, version_key("messages", reader_id), version_key("messages", peer_id))
+    read = len(unread_ids)
+    await db.execute(
+        update(Conversation).where(Conversation.user_id == reader_id, Conversation.peer_id == peer_id).values(
+            unread_count=case((Conversation.unread_count > read, Conversation.unread_count - read), else_=0)
+        )
+    )
+    return unread_ids
+
+def encode_cursor(timestamp, item_id):
+    raw = f"{timestamp.isoformat()}|{item_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
     try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, item_id = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), item_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-# Create the main app
-app = FastAPI()
+class DatabaseWriter:
+    """The one task allowed to write to SQLite in production mode.
+
+    Jobs are async callables taking the writer's session. Each pass drains
+    whatever is queued, up to `max_batch` jobs, runs them in one transaction
+    and commits once, so concurrent senders share a commit instead of taking
+    turns on the database lock. If the batch fails it is rolled back and the
+    jobs are retried one transaction each, so a bad job only fails itself.
+    """
+
+    def __init__(self, session_factory, max_batch):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.jobs = 0
+        self.largest_batch = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        # A fresh context, so a start from inside a request doesn't count every later write against it
+        self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+
+    async def stop(self):
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def submit(self, job):
+        if self.task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future))
+        return await future
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = await self.queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.max_batch or self.queue.empty():
+                    break
+                item = self.queue.get_nowait()
+            stopping = item is None
+            if batch:
+                await self.commit_batch(batch)
+
+    async def commit_batch(self, batch):
+        try:
+            async with self.session_factory() as db:
+                results = [await job(db) for job, _ in batch]
+                await db.commit()
+        except Exception as exc:
+            if len(batch) == 1:
+                self.settle(batch[0][1], exception=exc)
+                return
+            logger.warning("Write batch of %d failed; retrying jobs individually", len(batch))
+            for item in batch:
+                await self.commit_batch([item])
+            return
+        self.batches += 1
+        self.jobs += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            self.settle(future, result=result)
+
+    @staticmethod
+    def settle(future, result=None, exception=None):
+        # The request may have gone away while its job was queued
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "largest_batch": self.largest_batch,
+        }
+
+db_writer = DatabaseWriter(WriteSessionLocal, int(os.environ.get("DB_WRITE_BATCH", 256))) if SQLITE_PRODUCTION_MODE else None
+
+async def run_write(job, db=None):
+    """Run `job(session)` and commit it, returning the job's result.
+
+    In SQLite production mode the job goes to the writer task; otherwise it
+    runs on `db`, or a fresh session when called outside a request.
+    """
+    if db_writer is not None:
+        return await db_writer.submit(job)
+    if db is None:
+        async with AsyncSessionLocal() as session:
+            return await run_write(job, session)
+    result = await job(db)
+    await db.commit()
+    return result
+
+# Message archive. Old history moves out of the messages table into one
+# append-only file per conversation, as zlib-compressed blocks of NDJSON in
+# (timestamp, id) order, each indexed by an ArchiveSegment row. Only a prefix
+# of each conversation is archived, so every archived message is older than
+# every message still in the table and paging just continues into the archive.
+MESSAGE_ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR", str(ROOT_DIR / "archive"))
+ARCHIVED_FIELDS = ("id", "sender_id", "receiver_id", "text", "timestamp", "is_read", "seq")
+
+def conversation_pair(user_id, peer_id):
+    return tuple(sorted((user_id, peer_id)))
+
+def segment_file(user_low, user_high):
+    # Sharded by prefix so no directory ends up with every conversation
+    return os.path.join(user_low[:2], f"{user_low}_{user_high}.seg")
+
+def encode_segment(messages):
+    return zlib.compress(b"".join(orjson.dumps({f: m[f] for f in ARCHIVED_FIELDS}) + b"\n" for m in messages))
+
+def decode_segment(data):
+    messages = []
+    for line in zlib.decompress(data).splitlines():
+        message = orjson.loads(line)
+        message["timestamp"] = datetime.fromisoformat(message["timestamp"])
+        messages.append(message)
+    return messages
+
+class SegmentReader:
+    """Reads archive blocks through memory maps of recently used segment files.
+
+    A map covers the file as it was when mapped; a block past its end (the
+    file has been appended to since) remaps the file. Thread safe, since
+    reads run in worker threads.
+    """
+
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, file, offset, length):
+        with self.lock:
+            mapped = self.maps.get(file)
+            if mapped is None or offset + length > len(mapped):
+                if mapped is not None:
+                    mapped.close()
+                with open(os.path.join(self.directory, file), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[file] = mapped
+            self.maps.move_to_end(file)
+            while len(self.maps) > self.maxsize:
+                self.maps.popitem(last=False)[1].close()
+            data = mapped[offset:offset + length]
+        return decode_segment(data)
+
+segment_reader = SegmentReader(MESSAGE_ARCHIVE_DIR, int(os.environ.get("ARCHIVE_OPEN_SEGMENT_FILES", 256)))
+
+async def load_archived_messages(db, user_id, peer_id, limit, before=None, after=None):
+    """Up to `limit` archived messages of a conversation, as message dicts.
+
+    With `after` they are the oldest ones past that (timestamp, id) position,
+    in ascending order; otherwise the newest ones before `before` (or overall),
+    in descending order.
+    """
+    user_low, user_high = conversation_pair(user_id, peer_id)
+    query = select(ArchiveSegment.file, ArchiveSegment.offset, ArchiveSegment.length).where(
+        ArchiveSegment.user_low == user_low, ArchiveSegment.user_high == user_high
+    )
+    # Every matching block but the first lies wholly past the position, so `limit` blocks are enough
+    if after:
+        query = query.where(tuple_(ArchiveSegment.last_timestamp, ArchiveSegment.last_id) > after)
+        query = query.order_by(ArchiveSegment.first_timestamp)
+    else:
+        if before:
+            query = query.where(tuple_(ArchiveSegment.first_timestamp, ArchiveSegment.first_id) < before)
+        query = query.order_by(ArchiveSegment.first_timestamp.desc())
+    segments = (await db.execute(query.limit(limit))).all()
+
+    messages = []
+    for segment in segments:
+        block = await asyncio.to_thread(segment_reader.read, segment.file, segment.offset, segment.length)
+        if after:
+            messages.extend(m for m in block if (m["timestamp"], m["id"]) > after)
+        else:
+            messages.extend(m for m in reversed(block) if before is None or (m["timestamp"], m["id"]) < before)
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+async def load_segment_messages(db, message_ids):
+    """Archived messages by id, from a {segment id: message ids} mapping."""
+    segments = (await db.execute(
+        select(ArchiveSegment.file, ArchiveSegment.offset, ArchiveSegment.length)
+        .where(ArchiveSegment.id.in_(message_ids))
+    )).all()
+    wanted = set().union(*message_ids.values())
+    messages = {}
+    for segment in segments:
+        block = await asyncio.to_thread(segment_reader.read, segment.file, segment.offset, segment.length)
+        messages.update((m["id"], m) for m in block if m["id"] in wanted)
+    return messages
+
+async def load_conversation_messages(db, user_id, peer_id, limit, before=None, after=None):
+    """Up to `limit` messages of a conversation from the table, ordered like
+    load_archived_messages: ascending past `after`, else descending before `before`.
+
+    Each direction is its own range scan of ix_messages_conversation, cut to
+    `limit`, and only the two short lists are merged; a single OR across both
+    directions would read and sort the whole conversation for every page.
+    """
+    position = tuple_(Message.timestamp, Message.id)
+    if after:
+        order = (Message.timestamp, Message.id)
+    else:
+        order = (Message.timestamp.desc(), Message.id.desc())
+
+    def direction(sender_id, receiver_id):
+        query = select(*MESSAGE_COLUMNS).where(Message.sender_id == sender_id, Message.receiver_id == receiver_id)
+        if after:
+            query = query.where(position > after)
+        elif before:
+            query = query.where(position < before)
+        return select(query.order_by(*order).limit(limit).subquery())
+
+    directions = [direction(user_id, peer_id)]
+    if peer_id != user_id:
+        directions.append(direction(peer_id, user_id))
+    merged = union_all(*directions).subquery()
+    if after:
+        merged_order = (merged.c.timestamp, merged.c.id)
+    else:
+        merged_order = (merged.c.timestamp.desc(), merged.c.id.desc())
+    rows = (await db.execute(select(merged).order_by(*merged_order).limit(limit))).all()
+    return [row._asdict() for row in rows]
+
+def append_segment(user_low, user_high, data):
+    """Append a block to the conversation's segment file and return (file, offset)."""
+    file = segment_file(user_low, user_high)
+    path = os.path.join(MESSAGE_ARCHIVE_DIR, file)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        # Two archivers must not interleave their blocks
+        fcntl.flock(f, fcntl.LOCK_EX)
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return file, offset
+
+async def archive_conversation(user_id, peer_id, cutoff, segment_size):
+    """Move a conversation's messages older than `cutoff` into its archive; return how many.
+
+    Unread messages stay in the table (read receipts and unread counts work
+    on the table), and so does everything after the oldest of them, to keep
+    the archive a prefix of the history. Each block is written and fsynced
+    before its index row is committed together with the deletion, so a crash
+    leaves at most unindexed bytes at the end of a file, which are never read.
+    """
+    user_low, user_high = conversation_pair(user_id, peer_id)
+    in_conversation = (
+        ((Message.sender_id == user_low) & (Message.receiver_id == user_high)) |
+        ((Message.sender_id == user_high) & (Message.receiver_id == user_low))
+    )
+    archived = 0
+    async with AsyncSessionLocal() as db:
+        oldest_unread = await db.scalar(select(func.min(Message.timestamp)).where(
+            in_conversation, Message.is_read == False, Message.sender_id != Message.receiver_id
+        ))
+        if oldest_unread is not None:
+            cutoff = min(cutoff, oldest_unread)
+        while True:
+            rows = (await db.execute(
+                select(*MESSAGE_COLUMNS).where(in_conversation, Message.timestamp < cutoff)
+                .order_by(Message.timestamp, Message.id).limit(segment_size)
+            )).all()
+            # End the read before the write, so SQLite doesn't hold a snapshot across it
+            await db.commit()
+            if not rows:
+                return archived
+            messages = [row._asdict() for row in rows]
+            data = encode_segment(messages)
+            file, offset = await asyncio.to_thread(append_segment, user_low, user_high, data)
+            segment = ArchiveSegment(
+                user_low=user_low, user_high=user_high, file=file, offset=offset, length=len(data),
+                message_count=len(messages),
+                first_timestamp=messages[0]["timestamp"], first_id=messages[0]["id"],
+                last_timestamp=messages[-1]["timestamp"], last_id=messages[-1]["id"],
+            )
+
+            async def commit_segment(session):
+                session.add(segment)
+                ids = [m["id"] for m in messages]
+                if write_engine.dialect.name == "sqlite":
+                    # Tells the search delete trigger to keep these messages indexed
+                    await session.flush()
+                    await session.execute(
+                        text("UPDATE message_search_keys SET segment_id = :segment_id WHERE message_id IN :ids")
+                        .bindparams(bindparam("ids", expanding=True)),
+                        {"segment_id": segment.id, "ids": ids},
+                    )
+                await session.execute(delete(Message).where(Message.id.in_(ids)))
+
+            await run_write(commit_segment)
+            archived += len(messages)
+
+# Create the main app; handlers that return ORJSONResponse themselves also skip jsonable_encoder
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+def migrate_database():
+    # Deployments that migrate as a separate step set DB_AUTO_MIGRATE=0
+    if os.environ.get("DB_AUTO_MIGRATE", "1") == "1":
+        run_migrations()
+
+# Bodies that are compressed already and would only cost CPU to gzip again
+COMPRESSED_MEDIA_TYPES = ("application/zip",)
+
+class SkipCompressedGZipResponder(GZipResponder):
+    async def send_with_gzip(self, message):
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            media_type = Headers(raw=message["headers"]).get("content-type", "").split(";")[0]
+            if media_type in COMPRESSED_MEDIA_TYPES:
+                # Takes the pass-through path meant for bodies with their own Content-Encoding
+                self.content_encoding_set = True
+
+class DynamicGZipMiddleware(GZipMiddleware):
+    """Gzip for API responses; /static serves its own precompressed variants and byte ranges."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/static/"):
+            await self.app(scope, receive, send)
+            return
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = SkipCompressedGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Added before the @app.middleware functions, so it sits inside them and sees whole bodies
+app.add_middleware(
+    DynamicGZipMiddleware,
+    minimum_size=int(os.environ.get("GZIP_MIN_SIZE", 1024)),
+    compresslevel=int(os.environ.get("GZIP_LEVEL", 5)),
+)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Create upload directory
-UPLOAD_DIR = os.path.join(ROOT_DIR, "static", "uploads")
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(ROOT_DIR, "static", "uploads"))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+# In-progress uploads, kept outside the served static directory. Finished
+# files are renamed into UPLOAD_DIR, so keep both on the same filesystem.
+PARTIAL_UPLOAD_DIR = os.environ.get("PARTIAL_UPLOAD_DIR", os.path.join(ROOT_DIR, "partial_uploads"))
+os.makedirs(PARTIAL_UPLOAD_DIR, exist_ok=True)
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 50 * 1024 * 1024))
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+def upload_extension(filename):
+    """Keep a short alphanumeric extension from the client's filename, if any."""
+    suffix = Path(filename or "").suffix.lower()
+    return suffix if re.fullmatch(r"\.[a-z0-9]{1,10}", suffix) else ""
+
+COMPRESSIBLE_TYPES = {"application/json", "application/javascript", "application/xml", "image/svg+xml"}
+
+def is_compressible(path):
+    media_type = mimetypes.guess_type(path)[0] or ""
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+def write_precompressed(path):
+    """Write .gz and .br siblings of a compressible upload.
+
+    A sibling is kept only if it saves at least 10% over the original.
+    """
+    if not is_compressible(path):
+        return
+    encoders = [(".gz", gzip.compress), (".br", brotli.compress)]
+    size = os.path.getsize(path)
+    for suffix, encode in encoders:
+        target = path + suffix
+        if os.path.exists(target):
+            continue
+        with open(path, "rb") as f:
+            compressed = encode(f.read())
+        if len(compressed) <= size * 0.9:
+            temp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(compressed)
+            os.replace(temp_path, target)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def write_chunks(handle, chunks, size, limit, digest=None):
+    """Append an async stream of chunks to `handle` off the event loop.
+
+    Returns the new total size; raises 413 once it would pass `limit`.
+    """
+    def write(chunk):
+        handle.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail="Файл слишком большой")
+        await asyncio.to_thread(write, chunk)
+    return size
+
+# Storage of finished uploads. Objects are named after their content
+# ("<sha256>.png", "thumbs/<sha256>-128.webp"), so a name, once written, never changes.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STORED_NAME = re.compile(r"(thumbs/)?[0-9a-f]{64}(-\d+)?(\.[a-z0-9]{1,10})?")
+
+class UploadStorage:
+    """Where finished uploads are kept and how clients reach them.
+
+    `url` is the stable address saved in the database and handed to clients.
+    Backends that let clients transfer bytes directly return presigned
+    requests from `presign_upload`; the others return None.
+    """
+
+    # Whether presign_upload returns requests
+    direct_uploads = False
+
+    def url(self, name):
+        raise NotImplementedError
+
+    async def exists(self, name):
+        raise NotImplementedError
+
+    async def save_file(self, temp_path, name):
+        """Move a finished local file in under `name`; if `name` exists the file is dropped."""
+        raise NotImplementedError
+
+    async def save_bytes(self, name, data):
+        raise NotImplementedError
+
+    async def read(self, name):
+        raise NotImplementedError
+
+    def presign_upload(self, name, size, sha256, content_type):
+        return None
+
+    async def download_response(self, name):
+        raise NotImplementedError
+
+class LocalStorage(UploadStorage):
+    """The uploads directory on this host, served by UploadStaticFiles under /static/uploads."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def url(self, name):
+        return f"/static/uploads/{name}"
+
+    async def exists(self, name):
+        return await asyncio.to_thread(os.path.exists, self.path(name))
+
+    async def save_file(self, temp_path, name):
+        def commit():
+            final_path = self.path(name)
+            if os.path.exists(final_path):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, final_path)
+                write_precompressed(final_path)
+        await asyncio.to_thread(commit)
+
+    async def save_bytes(self, name, data):
+        def write():
+            path = self.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        await asyncio.to_thread(write)
+
+    async def read(self, name):
+        return await asyncio.to_thread(Path(self.path(name)).read_bytes)
+
+    async def download_response(self, name):
+        if not await self.exists(name):
+            raise HTTPException(status_code=404, detail="Файл не найден")
+        return RedirectResponse(self.url(name), headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
+class S3Storage(UploadStorage):
+    """An S3-compatible bucket (AWS, MinIO, ...), reached by clients through presigned URLs.
+
+    boto3 is blocking, so calls run in threads. Credentials come from the
+    usual AWS environment variables or instance profile.
+    """
+
+    direct_uploads = True
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region=None, expires_in=3600, addressing_style="auto"):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expires_in = expires_in
+        self.client_error = ClientError
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url, region_name=region,
+            config=Config(signature_version="s3v4", s3={"addressing_style": addressing_style}),
+        )
+
+    def key(self, name):
+        return self.prefix + name
+
+    def url(self, name):
+        return f"/api/files/{name}"
+
+    async def exists(self, name):
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=self.key(name))
+        except self.client_error as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def object_args(self, name):
+        return {
+            "ContentType": mimetypes.guess_type(name)[0] or "application/octet-stream",
+            "CacheControl": IMMUTABLE_CACHE_CONTROL,
+        }
+
+    async def save_file(self, temp_path, name):
+        try:
+            if not await self.exists(name):
+                await asyncio.to_thread(
+                    self.client.upload_file, temp_path, self.bucket, self.key(name), ExtraArgs=self.object_args(name)
+                )
+        finally:
+            os.remove(temp_path)
+
+    async def save_bytes(self, name, data):
+        await asyncio.to_thread(
+            self.client.put_object, Bucket=self.bucket, Key=self.key(name), Body=data, **self.object_args(name)
+        )
+
+    async def read(self, name):
+        def get():
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(name))["Body"].read()
+        return await asyncio.to_thread(get)
+
+    def presign_upload(self, name, size, sha256, content_type):
+        # The checksum is signed, so the bucket refuses bytes that don't match the name
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        args = self.object_args(name)
+        if content_type:
+            args["ContentType"] = content_type
+        url = self.client.generate_presigned_url("put_object", Params={
+            "Bucket": self.bucket, "Key": self.key(name), "ContentLength": size, "ChecksumSHA256": checksum, **args,
+        }, ExpiresIn=self.expires_in)
+        return {
+            "method": "PUT",
+            "url": url,
+            "headers": {
+                "Content-Type": args["ContentType"],
+                "Cache-Control": args["CacheControl"],
+                "x-amz-checksum-sha256": checksum,
+            },
+            "expires_in": self.expires_in,
+        }
+
+    async def download_response(self, name):
+        url = self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self.key(name)}, ExpiresIn=self.expires_in
+        )
+        # Reuse the redirect while the signature still has a good while to run
+        return RedirectResponse(url, headers={"Cache-Control": f"private, max-age={self.expires_in // 2}"})
+
+def create_upload_storage(url):
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3Storage(
+            bucket,
+            prefix=prefix.rstrip("/") + "/" if prefix else "",
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+            region=os.environ.get("S3_REGION") or None,
+            expires_in=int(os.environ.get("S3_PRESIGN_EXPIRES", 3600)),
+            addressing_style=os.environ.get("S3_ADDRESSING_STYLE", "auto"),
+        )
+    return LocalStorage(UPLOAD_DIR)
+
+upload_storage = create_upload_storage(os.environ.get("UPLOAD_STORAGE_URL", "local://"))
+
+async def store_upload(chunks, filename):
+    """Stream chunks to content-addressed storage, hashing as they arrive."""
+    temp_path = os.path.join(PARTIAL_UPLOAD_DIR, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    handle = await asyncio.to_thread(open, temp_path, "wb")
+    try:
+        size = await write_chunks(handle, chunks, 0, MAX_UPLOAD_SIZE, digest)
+    except BaseException:
+        await asyncio.to_thread(handle.close)
+        os.remove(temp_path)
+        raise
+    await asyncio.to_thread(handle.close)
+
+    sha256 = digest.hexdigest()
+    name = sha256 + upload_extension(filename)
+    await upload_storage.save_file(temp_path, name)
+    return {"url": upload_storage.url(name), "size": size, "sha256": sha256}
+
+async def iter_upload_file(file):
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    # Multipart bodies are spooled before the handler runs, so refuse them up front
+    if request.url.path == "/api/upload":
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > MAX_UPLOAD_SIZE + UPLOAD_CHUNK_SIZE:
+            return JSONResponse(status_code=413, content={"detail": "Файл слишком большой"})
+    return await call_next(request)
+
+# Instrumentation: per-route latency and status, in-flight requests, and the
+# queries each request issues, exported in Prometheus format at /metrics
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+# PROFILING_ENABLED=1 lets a request add ?profile=1 to get a sampling profile instead of its response
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time until the response starts, by route", ["method", "route"]
+)
+REQUESTS = Counter("http_requests_total", "Requests by route and status code", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being handled")
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries issued per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, float("inf"))
+)
+REQUEST_QUERY_TIME = Histogram("http_request_db_seconds", "Time spent in database queries per request", ["route"])
+DB_QUERIES = Counter("db_queries_total", "Database queries, including background work")
+DB_QUERY_TIME = Counter("db_query_seconds_total", "Time spent in database queries, including background work")
+SLOW_QUERIES = Counter("db_slow_queries_total", "Queries slower than SLOW_QUERY_MS")
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+# Set per request by the metrics middleware; query hooks add to it
+request_query_stats = contextvars.ContextVar("request_query_stats", default=None)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    DB_QUERIES.inc()
+    DB_QUERY_TIME.inc(elapsed)
+    stats = request_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc()
+        logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, " ".join(statement.split())[:500])
+
+for instrumented_engine in (async_engine.sync_engine, write_engine.sync_engine):
+    event.listen(instrumented_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(instrumented_engine, "after_cursor_execute", after_cursor_execute)
+
+def route_label(request):
+    # The route template keeps label cardinality bounded
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+async def profile_request(request, call_next):
+    from pyinstrument import Profiler
+
+    profiler = Profiler(async_mode="enabled")
+    profiler.start()
+    response = await call_next(request)
+    # Streaming handlers do their work while the body is read
+    async for _ in response.body_iterator:
+        pass
+    profiler.stop()
+    return Response(profiler.output_html(), media_type="text/html")
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    if PROFILING_ENABLED and request.query_params.get("profile") == "1":
+        return await profile_request(request, call_next)
+
+    stats = QueryStats()
+    request_query_stats.set(stats)
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = route_label(request)
+        REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - start)
+        REQUESTS.labels(request.method, route, str(status)).inc()
+        REQUEST_QUERIES.labels(route).observe(stats.count)
+        REQUEST_QUERY_TIME.labels(route).observe(stats.seconds)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# Write admission: a token bucket per (route, user), then a process-wide cap
+# on concurrent writes that sheds load instead of queueing without bound
+RATE_LIMITED = Counter("rate_limited_total", "Write requests refused by the per-user rate limit", ["route"])
+ADMISSION_REJECTED = Counter("admission_rejected_total", "Write requests shed by admission control", ["route", "reason"])
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Admitted write requests being handled")
+ADMISSION_QUEUED = Gauge("admission_queued", "Write requests waiting for a slot")
+ADMISSION_WAIT = Histogram("admission_wait_seconds", "Time write requests waited for a slot", ["route"])
+
+class RateLimitStore:
+    """Keeps the token buckets.
+
+    `take` removes a token from the bucket at `key`, which refills at `rate`
+    tokens a second up to `burst`, and returns 0; with the bucket empty it
+    returns how many seconds until the next token instead.
+    """
+
+    async def take(self, key, rate, burst):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+class InMemoryRateLimitStore(RateLimitStore):
+    """Per-process buckets; the least recently used go past `maxsize`, which only refills them."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+
+    async def take(self, key, rate, burst):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.maxsize:
+            self.buckets.popitem(last=False)
+        return wait
+
+class RedisRateLimitStore(RateLimitStore):
+    """Buckets in Redis, shared by every worker; the script updates a bucket atomically."""
+
+    SCRIPT = """
+        local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or burst
+        tokens = math.min(burst, tokens + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, url, prefix="messenger:ratelimit:"):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(self.SCRIPT)
+
+    async def take(self, key, rate, burst):
+        return float(await self.script(keys=[self.prefix + key], args=[rate, burst]))
+
+    async def stop(self):
+        await self.client.close()
+
+def create_rate_limit_store(url):
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisRateLimitStore(url)
+    return InMemoryRateLimitStore(int(os.environ.get("RATE_LIMIT_MAX_KEYS", 100000)))
+
+def parse_rate_limit(value):
+    # "<tokens per second>,<burst>"; a rate of 0 turns the limit off
+    rate, burst = (float(part) for part in value.split(","))
+    return (rate, max(burst, 1.0)) if rate > 0 else None
+
+# Per user, per route group; the other ways to start an upload share the "upload" bucket
+RATE_LIMITS = {
+    "messages": parse_rate_limit(os.environ.get("RATE_LIMIT_MESSAGES", "5,30")),
+    "favorites": parse_rate_limit(os.environ.get("RATE_LIMIT_FAVORITES", "2,20")),
+    "upload": parse_rate_limit(os.environ.get("RATE_LIMIT_UPLOADS", "0.5,10")),
+}
+rate_limit_store = create_rate_limit_store(os.environ.get("RATE_LIMIT_URL", "memory://"))
+
+class AdmissionController:
+    """Caps concurrent write requests in this process.
+
+    Requests past `max_concurrent` wait for a slot. Rather than let the wait
+    grow, a request is turned away with 503 when `max_queue` are already
+    waiting, when the database writer's queue is past `max_writer_queue`, or
+    when no slot frees up within `max_wait` seconds.
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_wait, max_writer_queue, retry_after):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_writer_queue = max_writer_queue
+        self.retry_after = retry_after
+        self.semaphore = None
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def reject(self, route, reason):
+        self.rejected += 1
+        ADMISSION_REJECTED.labels(route, reason).inc()
+        raise HTTPException(
+            status_code=503, detail="Сервер перегружен, повторите позже",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    @contextlib.asynccontextmanager
+    async def slot(self, route):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        if self.semaphore.locked() and self.queued >= self.max_queue:
+            self.reject(route, "queue")
+        if db_writer is not None and db_writer.queue is not None and db_writer.queue.qsize() > self.max_writer_queue:
+            self.reject(route, "writer")
+
+        start = time.perf_counter()
+        self.queued += 1
+        ADMISSION_QUEUED.inc()
+        try:
+            async with asyncio.timeout(self.max_wait):
+                await self.semaphore.acquire()
+        except TimeoutError:
+            self.reject(route, "wait")
+        finally:
+            self.queued -= 1
+            ADMISSION_QUEUED.dec()
+        ADMISSION_WAIT.labels(route).observe(time.perf_counter() - start)
+
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.inc()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            ADMISSION_IN_FLIGHT.dec()
+            self.semaphore.release()
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "queued": self.queued, "rejected": self.rejected}
+
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get("ADMISSION_MAX_CONCURRENT", 64)),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 256)),
+    max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 2)),
+    max_writer_queue=int(os.environ.get("ADMISSION_MAX_WRITER_QUEUE", 1000)),
+    retry_after=int(os.environ.get("ADMISSION_RETRY_AFTER", 1)),
+)
+
+def limited_writer(route):
+    """Dependency for write endpoints: the authenticated user id, once the
+    user's bucket for `route` had a token and the request got a write slot."""
+    async def dependency(current_user_id: str = Depends(get_current_user_id)):
+        limit = RATE_LIMITS[route]
+        if limit is not None:
+            wait = await rate_limit_store.take(f"{route}:{current_user_id}", *limit)
+            if wait > 0:
+                RATE_LIMITED.labels(route).inc()
+                raise HTTPException(
+                    status_code=429, detail="Слишком много запросов",
+                    headers={"Retry-After": str(math.ceil(wait))},
+                )
+        async with admission.slot(route):
+            yield current_user_id
+    return dependency
+
+# Avatar thumbnails
+AVATAR_SIZES = (48, 128, 256)
+THUMBNAIL_FORMAT, THUMBNAIL_EXTENSION = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+thumbnail_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("THUMBNAIL_WORKERS", 2)), thread_name_prefix="thumbnail"
+)
+pending_thumbnails = set()
+background_tasks = set()
+
+def spawn_background(coro):
+    # Keep a reference so the task isn't garbage collected mid-flight
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def render_thumbnails(data, sizes):
+    """Encode a square thumbnail of the image in `data` per size; return {size: bytes}."""
+    rendered = {}
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if THUMBNAIL_FORMAT == "WEBP" else "RGB")
+        for size in sizes:
+            buffer = io.BytesIO()
+            ImageOps.fit(image, (size, size), Image.LANCZOS).save(buffer, format=THUMBNAIL_FORMAT, quality=85)
+            rendered[size] = buffer.getvalue()
+    return rendered
+
+async def generate_avatar_thumbnails(user_id, avatar_url):
+    """Store a thumbnail per avatar size and record their URLs on the user.
+
+    Names derive from the (content-addressed) source name, so stored thumbnails are reused.
+    """
+    source_name = os.path.basename(avatar_url)
+    names = {size: f"thumbs/{Path(source_name).stem}-{size}.{THUMBNAIL_EXTENSION}" for size in AVATAR_SIZES}
+    try:
+        missing = [size for size in AVATAR_SIZES if not await upload_storage.exists(names[size])]
+        if missing:
+            data = await upload_storage.read(source_name)
+            rendered = await asyncio.get_running_loop().run_in_executor(thumbnail_executor, render_thumbnails, data, missing)
+            for size, thumbnail in rendered.items():
+                await upload_storage.save_bytes(names[size], thumbnail)
+    except Exception:
+        logger.exception("Failed to render thumbnails for %s", avatar_url)
+        return
+    finally:
+        pending_thumbnails.discard(avatar_url)
+    variants = {str(size): upload_storage.url(name) for size, name in names.items()}
+
+    async def save_variants(db):
+        # Skip if the user switched avatars while we were rendering
+        result = await db.execute(
+            update(User).where(User.id == user_id, User.avatar == avatar_url).values(avatar_thumbnails=variants)
+        )
+        if result.rowcount:
+            await bump_profile_versions(db, user_id)
+
+    await run_write(save_variants)
+
+def schedule_avatar_thumbnails(user_id, avatar_url):
+    if avatar_url not in pending_thumbnails:
+        pending_thumbnails.add(avatar_url)
+        spawn_background(generate_avatar_thumbnails(user_id, avatar_url))
+
+# Cache-aware serving of uploads
+# Uploads and their thumbnails are named after a SHA-256 of the source content
+CONTENT_ADDRESSED_NAME = re.compile(r"([0-9a-f]{64})(-\d+)?(\.[a-z0-9]{1,10})?")
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# Older uploads (and their thumbnails) have random names. They aren't rewritten
+# either, but without a hash in the name they are only cached for a while and
+# then revalidated against their ETag and Last-Modified.
+LEGACY_UPLOAD_CACHE_CONTROL = f"public, max-age={int(os.environ.get('LEGACY_UPLOAD_MAX_AGE', 86400))}"
+legacy_file_hashes = {}
+
+def file_etag(path, stat_result):
+    """Strong ETag: the hash in a content-addressed name, else a cached SHA-256 of the bytes."""
+    match = CONTENT_ADDRESSED_NAME.fullmatch(os.path.basename(path))
+    if match:
+        return f'"{match.group(1)}{match.group(2) or ""}"'
+    key = (path, stat_result.st_mtime_ns, stat_result.st_size)
+    if key not in legacy_file_hashes:
+        legacy_file_hashes[key] = hash_file(path)
+    return f'"{legacy_file_hashes[key]}"'
+
+def stat_file(path):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return stat_result if stat.S_ISREG(stat_result.st_mode) else None
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+def etag_matches(header, etag):
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def parse_byte_range(header, size):
+    """Resolve a single `bytes=` range to inclusive (start, end).
+
+    Returns None for anything we don't serve partially (other units, multiple
+    ranges, malformed specs), which means sending the whole file instead.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+async def iter_file_range(path, start, length):
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+class UploadStaticFiles(StaticFiles):
+    """Static files with validation, byte ranges and precompressed variants for uploads.
+
+    Content-addressed uploads never change, so they are cached as immutable;
+    anything else is cached for LEGACY_UPLOAD_MAX_AGE, then revalidated.
+    """
+
+    async def get_response(self, path, scope):
+        if scope["method"] in ("GET", "HEAD"):
+            full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path)
+            if stat_result and stat.S_ISREG(stat_result.st_mode):
+                return await self.upload_response(full_path, stat_result, scope)
+        return await super().get_response(path, scope)
+
+    async def upload_response(self, full_path, stat_result, scope):
+        request_headers = Headers(scope=scope)
+        name = os.path.basename(full_path)
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        etag = await anyio.to_thread.run_sync(file_etag, full_path, stat_result)
+        headers = {
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if CONTENT_ADDRESSED_NAME.fullmatch(name) else LEGACY_UPLOAD_CACHE_CONTROL,
+            "Accept-Ranges": "bytes",
+            "Vary": "Accept-Encoding",
+        }
+
+        byte_range = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if byte_range and if_range and if_range != etag:
+            byte_range = None
+
+        # Ranges address the identity encoding, so only whole-file responses use siblings
+        if not byte_range and is_compressible(name):
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                sibling_stat = await anyio.to_thread.run_sync(stat_file, full_path + suffix)
+                if sibling_stat:
+                    full_path, stat_result = full_path + suffix, sibling_stat
+                    etag = f'{etag[:-1]}-{encoding}"'
+                    headers["Content-Encoding"] = encoding
+                    break
+        headers["ETag"] = etag
+
+        if etag_matches(request_headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
+
+        if byte_range:
+            resolved = parse_byte_range(byte_range, stat_result.st_size)
+            if resolved:
+                start, end = resolved
+                length = end - start + 1
+                headers["Content-Range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+                headers["Content-Length"] = str(length)
+                if scope["method"] == "HEAD":
+                    return Response(status_code=206, headers=headers, media_type=media_type)
+                return StreamingResponse(
+                    iter_file_range(full_path, start, length), status_code=206, headers=headers, media_type=media_type
+                )
+
+        return FileResponse(full_path, stat_result=stat_result, headers=headers, media_type=media_type)
 
 # Mount static files
-app.mount("/static", StaticFiles(directory=os.path.join(ROOT_DIR, "static")), name="static")
+app.mount("/static/uploads", UploadStaticFiles(directory=UPLOAD_DIR), name="uploads")
+
+# Real-time push
+class ConnectionRegistry:
+    """Open WebSocket connections of this worker, keyed by user id."""
+
+    def __init__(self):
+        self.connections = {}
+
+    def add(self, user_id, websocket):
+        self.connections.setdefault(user_id, set()).add(websocket)
+
+    def remove(self, user_id, websocket):
+        sockets = self.connections.get(user_id)
+        if sockets:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.connections[user_id]
+
+    async def deliver(self, user_id, event):
+        for websocket in list(self.connections.get(user_id, ())):
+            try:
+                await websocket.send_json(event)
+            except Exception:
+                # The socket died between sends; its handler will clean up too
+                self.remove(user_id, websocket)
+
+class PubSubBackend:
+    """Carries events between workers.
+
+    `publish` may be called from any worker; every worker's `deliver`
+    callback receives each event and pushes it to its own local sockets.
+    """
+
+    async def start(self, deliver):
+        raise NotImplementedError
+
+    async def publish(self, user_id, event):
+        raise NotImplementedError
+
+    async def stop(self):
+        pass
+
+class InMemoryPubSub(PubSubBackend):
+    """Single-process backend: publishing delivers straight to local sockets."""
+
+    def __init__(self):
+        self.deliver = None
+
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    async def publish(self, user_id, event):
+        # Before startup there are no sockets to deliver to
+        if self.deliver:
+            await self.deliver(user_id, event)
+
+class RedisPubSub(PubSubBackend):
+    """Fans events out through a Redis channel so every uvicorn worker sees them.
+
+    If the subscription drops, the listener resubscribes with exponential
+    backoff; events published meanwhile are missed, and clients catch up
+    through /api/sync.
+    """
+
+    def __init__(self, url, channel="messenger:events", min_backoff=0.5, max_backoff=30):
+        self.url = url
+        self.channel = channel
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.listener = None
+        self.reconnects = 0
+
+    async def start(self, deliver):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(self.url)
+        self.pubsub = self.client.pubsub()
+        await self.pubsub.subscribe(self.channel)
+        self.listener = asyncio.create_task(self._listen(deliver))
+
+    async def _listen(self, deliver):
+        backoff = self.min_backoff
+        while True:
+            try:
+                if self.pubsub is None:
+                    self.pubsub = self.client.pubsub()
+                    await self.pubsub.subscribe(self.channel)
+                    self.reconnects += 1
+                    logger.info("Resubscribed to Redis pub/sub")
+                async for item in self.pubsub.listen():
+                    backoff = self.min_backoff
+                    if item["type"] != "message":
+                        continue
+                    try:
+                        payload = json.loads(item["data"])
+                        await deliver(payload["user_id"], payload["event"])
+                    except Exception:
+                        logger.exception("Failed to deliver pub/sub event")
+                logger.warning("Redis pub/sub subscription ended; resubscribing in %.1fs", backoff)
+            except Exception:
+                logger.exception("Redis pub/sub listener failed; resubscribing in %.1fs", backoff)
+            await self._drop_subscription()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _drop_subscription(self):
+        pubsub, self.pubsub = self.pubsub, None
+        if pubsub is not None:
+            try:
+                await pubsub.reset()
+            except Exception:
+                logger.debug("Failed to close a dropped Redis pub/sub connection", exc_info=True)
+
+    async def publish(self, user_id, event):
+        await self.client.publish(self.channel, json.dumps({"user_id": user_id, "event": event}))
+
+    async def stop(self):
+        if self.listener:
+            self.listener.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.unsubscribe(self.channel)
+        await self.client.close()
+
+def create_pubsub_backend(url):
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisPubSub(url)
+    return InMemoryPubSub()
+
+connection_registry = ConnectionRegistry()
+pubsub = create_pubsub_backend(os.environ.get("PUBSUB_URL", "memory://"))
+
+async def publish_event(user_id, event):
+    try:
+        await pubsub.publish(user_id, jsonable_encoder(event))
+    except Exception:
+        # Push is best effort; clients still catch up through /api/sync
+        logger.exception("Failed to publish event to %s", user_id)
+
+async def deliver_event(user_id, event):
+    await connection_registry.deliver(user_id, event)
+
+class ReadReceiptBuffer:
+    """Coalesces "read up to" marks in memory and writes them in periodic batches.
+
+    Only the furthest position per (reader, peer) is kept, so repeated marks
+    from several tabs cost one UPDATE per conversation per flush, and the
+    whole batch shares a single transaction.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.task = None
+
+    def mark(self, reader_id, peer_id, position):
+        key = (reader_id, peer_id)
+        current = self.pending.get(key)
+        if current is None or position > current:
+            self.pending[key] = position
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+
+        async def apply(db):
+            events = []
+            for (reader_id, peer_id), position in batch.items():
+                read_ids = await mark_conversation_read(db, reader_id, peer_id, position)
+                if read_ids:
+                    events.append((peer_id, {"type": "read", "reader_id": reader_id, "message_ids": read_ids}))
+            return events
+
+        try:
+            events = await run_write(apply)
+        except Exception:
+            logger.exception("Failed to flush read receipts; retrying next interval")
+            for (reader_id, peer_id), position in batch.items():
+                self.mark(reader_id, peer_id, position)
+            return
+        for peer_id, event in events:
+            await publish_event(peer_id, event)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+
+read_receipts = ReadReceiptBuffer(float(os.environ.get("READ_RECEIPT_FLUSH_INTERVAL", 0.5)))
+
+class PresenceTracker:
+    """Tracks user activity in memory and writes last_online in periodic batches.
+
+    `touch` runs on every authenticated request and socket heartbeat and only
+    updates a dict; each flush stores the newest activity of every user seen
+    since the last one in a single bulk UPDATE. Other workers track their own
+    users, so lookups also consult the stored last_online.
+    """
+
+    def __init__(self, interval, online_window, max_retries=3):
+        self.interval = interval
+        self.online_window = timedelta(seconds=online_window)
+        # A batch that keeps failing is dropped after this many retries
+        self.max_retries = max_retries
+        self.failures = 0
+        self.last_seen = {}
+        self.pending = {}
+        self.task = None
+
+    def touch(self, user_id):
+        now = datetime.utcnow()
+        self.last_seen[user_id] = now
+        self.pending[user_id] = now
+
+    async def flush(self):
+        # Users who went quiet are answered from the database from now on
+        cutoff = datetime.utcnow() - self.online_window
+        self.last_seen = {user_id: seen for user_id, seen in self.last_seen.items() if seen >= cutoff}
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+
+        async def store(session):
+            # A token can outlive its user, so only existing rows are updated
+            existing = (await session.scalars(select(User.id).where(User.id.in_(batch)))).all()
+            if existing:
+                await session.execute(
+                    update(User.__table__).where(User.__table__.c.id == bindparam("user_id"))
+                    .values(last_online=bindparam("seen")),
+                    [{"user_id": user_id, "seen": batch[user_id]} for user_id in existing],
+                )
+                await bump_profile_versions(session, *existing)
+
+        try:
+            await run_write(store)
+        except Exception:
+            self.failures += 1
+            if self.failures > self.max_retries:
+                logger.exception("Failed to flush presence %d times; dropping %d updates", self.failures, len(batch))
+                self.failures = 0
+                return
+            logger.exception("Failed to flush presence; retrying next interval")
+            for user_id, seen in batch.items():
+                self.pending.setdefault(user_id, seen)
+            return
+        self.failures = 0
+
+    async def lookup(self, db, viewer_id, user_ids):
+        """Return {user_id: {"online", "last_online"}} as `viewer_id` may see it."""
+        rows = (await db.execute(
+            select(User.id, User.last_online, User.invisible_mode, User.hide_last_seen).where(User.id.in_(user_ids))
+        )).all()
+        cutoff = datetime.utcnow() - self.online_window
+        result = {}
+        for row in rows:
+            seen = max((t for t in (row.last_online, self.last_seen.get(row.id)) if t is not None), default=None)
+            online = row.id in connection_registry.connections or (seen is not None and seen >= cutoff)
+            if row.id != viewer_id:
+                if row.invisible_mode:
+                    online, seen = False, None
+                elif row.hide_last_seen:
+                    seen = None
+            result[row.id] = {"online": online, "last_online": seen}
+        return result
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush presence")
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        await self.flush()
+
+presence = PresenceTracker(
+    interval=float(os.environ.get("PRESENCE_FLUSH_INTERVAL", 30)),
+    online_window=float(os.environ.get("PRESENCE_ONLINE_WINDOW", 90)),
+)
+
+@app.on_event("startup")
+async def start_pubsub():
+    if db_writer is not None:
+        db_writer.start()
+    await pubsub.start(deliver_event)
+    read_receipts.start()
+    presence.start()
+    upload_sweeper.start()
+
+@app.on_event("shutdown")
+async def stop_pubsub():
+    await read_receipts.stop()
+    await presence.stop()
+    await upload_sweeper.stop()
+    if db_writer is not None:
+        await db_writer.stop()
+    await pubsub.stop()
+    await rate_limit_store.stop()
+
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket, token: str = ""):
+    try:
+        user_id = await get_current_user_id(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+
+    await websocket.accept()
+    connection_registry.add(user_id, websocket)
+    try:
+        while True:
+            # Clients may send "ping" heartbeats; nothing else is expected
+            if await websocket.receive_text() == "ping":
+                presence.touch(user_id)
+                await websocket.send_json({"type": "pong"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        connection_registry.remove(user_id, websocket)
 
 # Pydantic models
 class UserCreate(BaseModel):
@@ -141,16 +2010,37 @@ class FavoriteCreate(BaseModel):
     voice_url: Optional[str] = None
     orig: Optional[dict] = None
 
+class ReadMark(BaseModel):
+    message_id: str
+
+class PresenceQuery(BaseModel):
+    user_ids: List[str] = Field(max_length=500)
+
+class FavoriteBulkUpdate(BaseModel):
+    add: List[FavoriteCreate] = Field(default_factory=list, max_length=500)
+    remove: List[str] = Field(default_factory=list, max_length=500)
+
 class ProfileUpdate(BaseModel):
     new_username: str
 
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: Optional[int] = None
+    content_type: Optional[str] = None
+
+class DirectUploadCreate(BaseModel):
+    filename: str
+    size: int = Field(ge=0)
+    sha256: str = Field(pattern=r"^[0-9a-f]{64}$")
+    content_type: Optional[str] = None
+
 # Authentication routes
 @api_router.post("/register")
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     # Check if user already exists
-    existing_user = db.query(User).filter(
+    existing_user = await db.scalar(select(User).where(
         (User.email == user_data.email) | (User.username == user_data.username)
-    ).first()
+    ))
     
     if existing_user:
         if existing_user.email == user_data.email:
@@ -158,170 +2048,904 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         else:
             raise HTTPException(status_code=400, detail="Имя пользователя уже занято")
     
+    # End the read transaction so the connection returns to the pool while bcrypt runs
+    await db.commit()
+
     # Create new user
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await password_hasher.hash(user_data.password)
     user = User(
         username=user_data.username,
         email=user_data.email,
         password=hashed_password
     )
     
-    db.add(user)
-    db.commit()
-    db.refresh(user)
+    async def create(session):
+        session.add(user)
+        await bump_versions(session, version_key("users"))
+
+    await run_write(create, db)
     
-    return {"user_id": user.id, "username": user.username, "email": user.email}
+    return {"user_id": user.id, "username": user.username, "email": user.email, "token": create_access_token(user.id)}
 
 @api_router.post("/login")
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == user_data.email).first()
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(User).where(User.email == user_data.email))
+    # End the read transaction so the connection returns to the pool while bcrypt runs
+    await db.commit()
     
-    if not user or not verify_password(user_data.password, user.password):
+    if not user or not await password_hasher.verify(user_data.password, user.password):
         raise HTTPException(status_code=401, detail="Неверный email или пароль")
     
-    # Update last online
-    user.last_online = datetime.utcnow()
-    db.commit()
+    presence.touch(user.id)
     
-    return {"user_id": user.id, "username": user.username, "email": user.email}
+    return {"user_id": user.id, "username": user.username, "email": user.email, "token": create_access_token(user.id)}
 
 @api_router.get("/users")
-async def get_users(token: str, db: Session = Depends(get_db)):
-    # Verify token (user_id)
-    current_user = db.query(User).filter(User.id == token).first()
-    if not current_user:
-        raise HTTPException(status_code=401, detail="Недействительный токен")
-    
-    users = db.query(User).filter(User.id != token).all()
-    return {"users": [{"id": u.id, "username": u.username, "avatar": u.avatar, "last_online": u.last_online} for u in users]}
+async def get_users(request: Request, current_user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)):
+    etag = await version_etag(db, version_key("users"))
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    query = select(*USER_LIST_COLUMNS).where(User.id != current_user_id)
+    return stream_rows(query, "users", wants_ndjson(request), revalidate_headers(etag))
+
+@api_router.get("/users/search")
+async def search_users(
+    q: str,
+    limit: int = Query(20, ge=1, le=50),
+    offset: int = Query(0, ge=0),
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    query = q.strip()
+    if not query:
+        return {"users": [], "has_more": False}
+
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    params = {"current_user_id": current_user_id, "prefix": escaped + "%", "limit": limit + 1, "offset": offset}
+    if async_engine.dialect.name == "postgresql":
+        # pg_trgm serves the ILIKE, the lower() pattern index serves short prefixes
+        if len(query) < 3:
+            params["prefix"] = escaped.lower() + "%"
+            sql = text("""
+                SELECT id, username, avatar, avatar_thumbnails,
+                    CASE WHEN hide_last_seen OR invisible_mode THEN NULL ELSE last_online END AS last_online
+                FROM users
+                WHERE lower(username) LIKE :prefix ESCAPE '\\' AND id != :current_user_id
+                ORDER BY lower(username)
+                LIMIT :limit OFFSET :offset
+            """)
+        else:
+            params["pattern"] = "%" + escaped + "%"
+            sql = text("""
+                SELECT id, username, avatar, avatar_thumbnails,
+                    CASE WHEN hide_last_seen OR invisible_mode THEN NULL ELSE last_online END AS last_online
+                FROM users
+                WHERE username ILIKE :pattern ESCAPE '\\' AND id != :current_user_id
+                ORDER BY username ILIKE :prefix ESCAPE '\\' DESC, lower(username)
+                LIMIT :limit OFFSET :offset
+            """)
+        sql = sql.columns(avatar_thumbnails=JSON, last_online=DateTime)
+    elif len(query) < 3:
+        # Too short for a trigram: prefix match on the NOCASE index only
+        sql = text("""
+            SELECT id, username, avatar, avatar_thumbnails,
+                CASE WHEN hide_last_seen OR invisible_mode THEN NULL ELSE last_online END AS last_online
+            FROM users
+            WHERE username LIKE :prefix ESCAPE '\\' AND id != :current_user_id
+            ORDER BY username COLLATE NOCASE
+            LIMIT :limit OFFSET :offset
+        """).columns(avatar_thumbnails=JSON, last_online=DateTime)
+    else:
+        # Substring match through the trigram index, prefix matches first
+        params["phrase"] = 'username : "' + query.replace('"', '""') + '"'
+        sql = text("""
+            SELECT u.id, u.username, u.avatar, u.avatar_thumbnails,
+                CASE WHEN u.hide_last_seen OR u.invisible_mode THEN NULL ELSE u.last_online END AS last_online
+            FROM user_search s
+            JOIN users u ON u.id = s.user_id
+            WHERE user_search MATCH :phrase AND u.id != :current_user_id
+            ORDER BY s.username LIKE :prefix ESCAPE '\\' DESC, s.username COLLATE NOCASE
+            LIMIT :limit OFFSET :offset
+        """).columns(avatar_thumbnails=JSON, last_online=DateTime)
+    rows = (await db.execute(sql, params)).all()
+
+    return {
+        "users": [{"id": r.id, "username": r.username, "avatar": r.avatar, "avatar_thumbnails": r.avatar_thumbnails, "last_online": r.last_online} for r in rows[:limit]],
+        "has_more": len(rows) > limit,
+    }
+
+@api_router.post("/presence")
+async def get_presence(query: PresenceQuery, current_user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)):
+    return {"presence": await presence.lookup(db, current_user_id, query.user_ids)}
 
 @api_router.get("/profile")
-async def get_profile(token: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == token).first()
+async def get_profile(request: Request, current_user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)):
+    version = await load_version(db, version_key("profile", current_user_id))
+    etag = version_tag(version)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    user = await load_user(db, current_user_id, version)
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
+    return ORJSONResponse({
+        "user_id": user["id"],
+        "username": user["username"],
+        "email": user["email"],
+        "avatar": user["avatar"],
+        "avatar_thumbnails": user["avatar_thumbnails"],
+        "last_online": user["last_online"],
+        "invisible_mode": user["invisible_mode"],
+        "hide_last_seen": user["hide_last_seen"],
+        "hide_profile_info": user["hide_profile_info"],
+        "theme": user["theme"],
+        "custom_primary_color": user["custom_primary_color"],
+        "custom_secondary_color": user["custom_secondary_color"]
+    }, headers=revalidate_headers(etag))
+
+@api_router.get("/messages/{user_id}")
+async def get_messages(
+    user_id: str,
+    request: Request,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Укажите только before или after")
+    etag = await version_etag(db, version_key("messages", current_user_id))
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    # Fetch one extra row to learn whether another page exists. Archived
+    # messages all precede the table's, so they come first going forward and
+    # only once the table runs out going back.
+    if after:
+        cursor = decode_cursor(after)
+        page = await load_archived_messages(db, current_user_id, user_id, limit + 1, after=cursor)
+        if len(page) <= limit:
+            page += await load_conversation_messages(db, current_user_id, user_id, limit + 1 - len(page), after=cursor)
+        has_more = len(page) > limit
+        messages = page[:limit]
+    else:
+        cursor = decode_cursor(before) if before else None
+        page = await load_conversation_messages(db, current_user_id, user_id, limit + 1, before=cursor)
+        if len(page) <= limit:
+            page += await load_archived_messages(db, current_user_id, user_id, limit + 1 - len(page), before=cursor)
+        has_more = len(page) > limit
+        messages = list(reversed(page[:limit]))
+
+    oldest = messages[0] if messages else None
+    newest = messages[-1] if messages else None
+    cursors = {
+        # Cursor for the next older page; None once the start of history is reached
+        "next_before": encode_cursor(oldest["timestamp"], oldest["id"]) if oldest and (after or has_more) else None,
+        # Cursor to poll for newer messages
+        "next_after": encode_cursor(newest["timestamp"], newest["id"]) if newest else after,
+    }
+
+    return ORJSONResponse({"messages": messages, "has_more": has_more, **cursors}, headers=revalidate_headers(etag))
+
+@api_router.post("/messages/{user_id}/read", status_code=202)
+async def mark_messages_read(
+    user_id: str,
+    read_data: ReadMark,
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    """Queue the peer's messages up to and including `message_id` to be marked read."""
+    message = (await db.execute(select(Message.timestamp, Message.id).where(
+        (Message.id == read_data.message_id) & (
+            ((Message.sender_id == current_user_id) & (Message.receiver_id == user_id)) |
+            ((Message.sender_id == user_id) & (Message.receiver_id == current_user_id))
+        )
+    ))).first()
+    if not message:
+        raise HTTPException(status_code=404, detail="Сообщение не найдено")
+
+    read_receipts.mark(current_user_id, user_id, (message.timestamp, message.id))
+    return {"status": "queued"}
+
+def encode_search_cursor(score, message_id):
+    raw = f"{score!r}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_search_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        score, message_id = raw.split("|", 1)
+        return float(score), message_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+
+# Snippet highlight markers: control characters can't come from the HTML we
+# escape afterwards, so they are swapped for <mark> tags only at the end
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03"
+
+def render_snippet(snippet):
+    return html.escape(snippet or "").replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>")
+
+@api_router.get("/search/messages")
+async def search_messages(
+    q: str,
+    peer_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=50),
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    """Best matches first among the caller's messages, optionally with one peer only.
+
+    Every term matches as a prefix, which also covers most inflected forms
+    (no stemming is configured). Each result carries an HTML-escaped snippet with the matches wrapped in <mark>.
+    """
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        return {"results": [], "next_cursor": None}
+
+    params = {"limit": limit + 1}
+    after = ""
+    if cursor:
+        params["after_score"], params["after_id"] = decode_search_cursor(cursor)
+        after = "AND (score > :after_score OR (score = :after_score AND id > :after_id))"
+
+    if async_engine.dialect.name == "postgresql":
+        # Served by the GIN index on to_tsvector('simple', text); ts_rank is negated to sort ascending
+        params.update(
+            tsquery=" & ".join(term + ":*" for term in terms),
+            me=current_user_id,
+            headline_options=f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords=24, MinWords=8",
+        )
+        scope = "(m.sender_id = :me OR m.receiver_id = :me)"
+        if peer_id:
+            params["peer"] = peer_id
+            scope = "((m.sender_id = :me AND m.receiver_id = :peer) OR (m.sender_id = :peer AND m.receiver_id = :me))"
+        sql = text(f"""
+            SELECT id, sender_id, receiver_id, text, timestamp, is_read, seq, score,
+                ts_headline('simple', coalesce(text, ''), query, :headline_options) AS snippet
+            FROM (
+                SELECT m.*, query, -ts_rank(to_tsvector('simple', coalesce(m.text, '')), query) AS score
+                FROM messages m, to_tsquery('simple', :tsquery) query
+                WHERE to_tsvector('simple', coalesce(m.text, '')) @@ query AND {scope}
+            ) ranked
+            WHERE true {after}
+            ORDER BY score, id
+            LIMIT :limit
+        """)
+    else:
+        # Participants are indexed too, so FTS5 intersects the text and caller postings itself
+        participants = [current_user_id] + ([peer_id] if peer_id else [])
+        phrases = " ".join(f'"{term}"*' for term in terms)
+        params["match"] = f"text : ({phrases})" + "".join(
+            f' AND participants : "{user_id.replace("-", "").replace(chr(34), "")}"' for user_id in participants
+        )
+        sql = text(f"""
+            SELECT * FROM (
+                SELECT message_search.message_id AS id, keys.segment_id,
+                    m.sender_id, m.receiver_id, m.text, m.timestamp, m.is_read, m.seq,
+                    message_search.rank AS score,
+                    snippet(message_search, 1, char(2), char(3), '…', 16) AS snippet
+                FROM message_search
+                JOIN message_search_keys keys ON keys.docid = message_search.rowid
+                LEFT JOIN messages m ON m.id = message_search.message_id
+                WHERE message_search MATCH :match AND (m.id IS NOT NULL OR keys.segment_id IS NOT NULL)
+            )
+            WHERE 1 {after}
+            ORDER BY score, id
+            LIMIT :limit
+        """)
+    rows = (await db.execute(sql.columns(timestamp=DateTime, is_read=Boolean), params)).all()
+    page = rows[:limit]
+
+    # Hits on archived messages (SQLite only) have no table row; read them from their segments
+    archived = {}
+    for r in page:
+        if r.sender_id is None:
+            archived.setdefault(r.segment_id, set()).add(r.id)
+    found = await load_segment_messages(db, archived) if archived else {}
+
     return {
-        "user_id": user.id,
-        "username": user.username,
-        "email": user.email,
-        "avatar": user.avatar,
-        "last_online": user.last_online,
-        "invisible_mode": user.invisible_mode,
-        "hide_last_seen": user.hide_last_seen,
-        "hide_profile_info": user.hide_profile_info,
-        "theme": user.theme,
-        "custom_primary_color": user.custom_primary_color,
-        "custom_secondary_color": user.custom_secondary_color
+        "results": [
+            {**(serialize_message(r) if r.sender_id is not None else found[r.id]), "snippet": render_snippet(r.snippet)}
+            for r in page
+        ],
+        "next_cursor": encode_search_cursor(page[-1].score, page[-1].id) if len(rows) > limit else None,
     }
 
-@api_router.get("/messages/{user_id}")
-async def get_messages(user_id: str, token: str, db: Session = Depends(get_db)):
-    messages = db.query(Message).filter(
-        ((Message.sender_id == token) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == token))
-    ).order_by(Message.timestamp).all()
-    
-    # Mark messages as read
-    db.query(Message).filter(
-        (Message.sender_id == user_id) & (Message.receiver_id == token) & (Message.is_read == False)
-    ).update({"is_read": True})
-    db.commit()
-    
-    return {"messages": [{"id": m.id, "sender_id": m.sender_id, "receiver_id": m.receiver_id, "text": m.text, "timestamp": m.timestamp, "is_read": m.is_read} for m in messages]}
+@api_router.get("/sync")
+async def sync_messages(
+    since: Optional[int] = None,
+    limit: int = Query(200, ge=1, le=1000),
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    """Return messages created or changed after the `since` high-water mark.
+
+    Rows carry their current state, so clients upsert them by id. Without
+    `since` only the current high-water mark is returned, to start syncing from.
+    """
+    if since is None:
+        current = (await db.execute(select(SyncCounter.value).where(SyncCounter.name == "messages"))).scalar_one()
+        return {"messages": [], "cursor": current, "has_more": False}
+
+    page = (await db.scalars(select(Message).where(
+        ((Message.sender_id == current_user_id) | (Message.receiver_id == current_user_id)) & (Message.seq > since)
+    ).order_by(Message.seq).limit(limit + 1))).all()
+    has_more = len(page) > limit
+    messages = page[:limit]
+
+    return {
+        "messages": [serialize_message(m) for m in messages],
+        "cursor": messages[-1].seq if messages else since,
+        "has_more": has_more,
+    }
+
+# Account export: the profile, every message (archived ones too) and the
+# favorites, streamed batch by batch. A finished export ends with a trailer
+# holding the `since` token for the next one, which then only sends what was
+# added or changed in between.
+EXPORT_FILES = {"profile": "profile.json", "message": "messages.ndjson", "favorite": "favorites.ndjson", "export": "export.json"}
+
+def encode_export_since(seq, segment, favorite):
+    raw = orjson.dumps({"seq": seq, "segment": segment, "favorite": favorite})
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_export_since(since):
+    try:
+        raw = orjson.loads(base64.urlsafe_b64decode(since + "=" * (-len(since) % 4)))
+        favorite = raw["favorite"] and (datetime.fromisoformat(raw["favorite"][0]), str(raw["favorite"][1]))
+        return int(raw["seq"]), int(raw["segment"]), favorite
+    except (ValueError, TypeError, KeyError, IndexError):
+        raise HTTPException(status_code=400, detail="Неверный параметр since")
+
+async def export_records(user_id, since):
+    """Yield (kind, [record, ...]) batches of the user's data, then the trailer.
+
+    Messages come from the table in change-feed order, up to the position the
+    export started at; later changes go to the next export. Archived messages
+    follow, read one block at a time from the segments indexed by the time the
+    table has been read, so a message archived meanwhile is still exported; an
+    incremental export only reads segments added since the previous one.
+    Messages can repeat across exports, so importers upsert them by id.
+    Removed favorites are not reported.
+    """
+    seq_since, segment_since, favorite_since = decode_export_since(since) if since else (0, 0, None)
+    counts = {"message": 0, "favorite": 0}
+    async with AsyncSessionLocal() as db:
+        profile = await db.execute(select(*(c for c in User.__table__.columns if c.name != "password")).where(User.id == user_id))
+        yield "profile", [profile.one()._asdict()]
+
+        seq = (await db.execute(select(SyncCounter.value).where(SyncCounter.name == "messages"))).scalar_one()
+        result = await db.stream(select(*MESSAGE_COLUMNS).where(
+            (Message.sender_id == user_id) | (Message.receiver_id == user_id), Message.seq > seq_since, Message.seq <= seq
+        ).order_by(Message.seq).execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for rows in result.partitions():
+            counts["message"] += len(rows)
+            yield "message", [row._asdict() for row in rows]
+
+        # Read after the table, so a block archived before that point is in range
+        segment = await db.scalar(select(func.coalesce(func.max(ArchiveSegment.id), 0)))
+        result = await db.stream(select(ArchiveSegment.file, ArchiveSegment.offset, ArchiveSegment.length).where(
+            (ArchiveSegment.user_low == user_id) | (ArchiveSegment.user_high == user_id),
+            ArchiveSegment.id > segment_since, ArchiveSegment.id <= segment
+        ).order_by(ArchiveSegment.id).execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for rows in result.partitions():
+            for row in rows:
+                block = await asyncio.to_thread(segment_reader.read, row.file, row.offset, row.length)
+                messages = [m for m in block if m["seq"] > seq_since]
+                if messages:
+                    counts["message"] += len(messages)
+                    yield "message", messages
+
+        query = select(*FAVORITE_COLUMNS).where(FavoriteMessage.user_id == user_id)
+        if favorite_since:
+            query = query.where(tuple_(FavoriteMessage.timestamp, FavoriteMessage.id) > favorite_since)
+        result = await db.stream(query.order_by(FavoriteMessage.timestamp, FavoriteMessage.id).execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for rows in result.partitions():
+            counts["favorite"] += len(rows)
+            favorite_since = (rows[-1].timestamp, rows[-1].id)
+            yield "favorite", [row._asdict() for row in rows]
+
+    yield "export", [{
+        "user_id": user_id,
+        "exported_at": datetime.utcnow(),
+        "incremental": bool(since),
+        "messages": counts["message"],
+        "favorites": counts["favorite"],
+        "since": encode_export_since(seq, segment, favorite_since and (favorite_since[0].isoformat(), favorite_since[1])),
+    }]
+
+class ZipStream(io.RawIOBase):
+    """Write-only file that hands over what was written; zipfile then writes a
+    streamable archive (data descriptors instead of seeking back)."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+async def export_ndjson(records):
+    async for kind, batch in records:
+        yield b"".join(orjson.dumps({"type": kind, "data": record}) + b"\n" for record in batch)
+
+async def export_zip(records):
+    sink = ZipStream()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED)
+    entry = current = None
+    async for kind, batch in records:
+        if kind != current:
+            if entry:
+                entry.close()
+            current = kind
+            entry = archive.open(EXPORT_FILES[kind], "w", force_zip64=True)
+        if kind in ("profile", "export"):
+            entry.write(orjson.dumps(batch[0], option=orjson.OPT_INDENT_2))
+        else:
+            entry.write(b"".join(orjson.dumps(record) + b"\n" for record in batch))
+        yield sink.take()
+    if entry:
+        entry.close()
+    archive.close()
+    yield sink.take()
+
+@api_router.get("/export")
+async def export_account(
+    format: str = Query("ndjson", pattern="^(ndjson|zip)$"),
+    since: Optional[str] = None,
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    """Download the account's data as NDJSON ({"type", "data"} lines) or as a zip.
+
+    Memory use doesn't grow with the history. Pass the `since` token of the
+    last line (export.json in the zip) to get only what is new; an export cut
+    off before that line has to be repeated.
+    """
+    if since:
+        decode_export_since(since)
+    if await db.scalar(select(User.id).where(User.id == current_user_id)) is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    records = export_records(current_user_id, since)
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    if format == "zip":
+        body, media_type = export_zip(records), "application/zip"
+    else:
+        body, media_type = export_ndjson(records), NDJSON_MEDIA_TYPE
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="messenger-export-{stamp}.{format}"',
+        "Cache-Control": "no-store",
+    })
+
+@api_router.get("/conversations")
+async def get_conversations(
+    before: Optional[str] = None,
+    limit: int = Query(30, ge=1, le=100),
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    """The caller's conversations, most recent first, with the last message and unread count of each."""
+    query = select(Conversation, User.username, User.avatar, User.avatar_thumbnails).join(
+        User, User.id == Conversation.peer_id
+    ).where(Conversation.user_id == current_user_id)
+    if before:
+        query = query.where(tuple_(Conversation.last_timestamp, Conversation.peer_id) < decode_cursor(before))
+    page = (await db.execute(
+        query.order_by(Conversation.last_timestamp.desc(), Conversation.peer_id.desc()).limit(limit + 1)
+    )).all()
+    rows = page[:limit]
+
+    result = [{
+        "peer_id": c.peer_id,
+        "username": username,
+        "avatar": avatar,
+        "avatar_thumbnails": avatar_thumbnails,
+        "last_message": {
+            "id": c.last_message_id,
+            "sender_id": c.last_sender_id,
+            "text": c.last_message_text,
+            "timestamp": c.last_timestamp,
+        },
+        "unread_count": c.unread_count,
+    } for c, username, avatar, avatar_thumbnails in rows]
+    last = rows[-1][0] if len(page) > limit else None
+
+    return {"conversations": result, "next_before": encode_cursor(last.last_timestamp, last.peer_id) if last else None}
+
+@api_router.get("/unread_counts")
+async def get_unread_counts(current_user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)):
+    rows = (await db.execute(select(Message.sender_id, func.count()).where(
+        (Message.receiver_id == current_user_id) & (Message.is_read == False)
+    ).group_by(Message.sender_id))).all()
+    return {"counts": {sender_id: count for sender_id, count in rows}}
+
+@api_router.get("/status")
+async def get_status(current_user_id: str = Depends(get_current_user_id)):
+    status = {"password_hashing": password_hasher.stats()}
+    if db_writer is not None:
+        status["database_writer"] = db_writer.stats()
+    status["admission"] = admission.stats()
+    return status
 
 @api_router.post("/messages")
-async def send_message(message_data: MessageCreate, token: str, db: Session = Depends(get_db)):
+async def send_message(message_data: MessageCreate, current_user_id: str = Depends(limited_writer("messages")), db: AsyncSession = Depends(get_db)):
     message = Message(
-        sender_id=token,
+        sender_id=current_user_id,
         receiver_id=message_data.receiver_id,
         text=message_data.text
     )
+
+    async def insert_message(session):
+        message.seq = await allocate_seq(session)
+        session.add(message)
+        await session.flush()
+        await record_conversation_message(session, message)
+
+    await run_write(insert_message, db)
+
+    await publish_event(message.receiver_id, {"type": "message", "message": serialize_message(message)})
     
-    db.add(message)
-    db.commit()
-    db.refresh(message)
-    
-    return {"id": message.id, "sender_id": message.sender_id, "receiver_id": message.receiver_id, "text": message.text, "timestamp": message.timestamp}
+    return {"id": message.id, "sender_id": message.sender_id, "receiver_id": message.receiver_id, "text": message.text, "timestamp": message.timestamp, "seq": message.seq}
 
 @api_router.get("/favorites")
-async def get_favorites(token: str, db: Session = Depends(get_db)):
-    favorites = db.query(FavoriteMessage).filter(FavoriteMessage.user_id == token).order_by(FavoriteMessage.timestamp.desc()).all()
-    result = []
-    
-    for fav in favorites:
-        fav_data = {
-            "id": fav.id,
-            "type": fav.type,
-            "text": fav.text,
-            "file_url": fav.file_url,
-            "voice_url": fav.voice_url,
-            "timestamp": fav.timestamp.timestamp() if fav.timestamp else None
-        }
-        if fav.orig:
-            try:
-                fav_data["orig"] = json.loads(fav.orig)
-            except:
-                fav_data["orig"] = fav.orig
-        result.append(fav_data)
+async def get_favorites(
+    request: Request,
+    before: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    current_user_id: str = Depends(get_current_user_id),
+    db: AsyncSession = Depends(get_db)
+):
+    etag = await version_etag(db, version_key("favorites", current_user_id))
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    query = select(*FAVORITE_COLUMNS).where(FavoriteMessage.user_id == current_user_id)
+    if before:
+        query = query.where(tuple_(FavoriteMessage.timestamp, FavoriteMessage.id) < decode_cursor(before))
+    page = (await db.execute(
+        query.order_by(FavoriteMessage.timestamp.desc(), FavoriteMessage.id.desc()).limit(limit + 1)
+    )).all()
+    favorites = page[:limit]
+
+    result = [{
+        "id": fav.id,
+        "type": fav.type,
+        "text": fav.text,
+        "file_url": fav.file_url,
+        "voice_url": fav.voice_url,
+        "timestamp": fav.timestamp.timestamp() if fav.timestamp else None,
+        "orig": fav.orig
+    } for fav in favorites]
+    last = favorites[-1] if len(page) > limit else None
     
-    return {"favorites": result}
+    return ORJSONResponse(
+        {"favorites": result, "next_before": encode_cursor(last.timestamp, last.id) if last else None},
+        headers=revalidate_headers(etag),
+    )
 
 @api_router.post("/favorites")
-async def add_favorite(favorite_data: FavoriteCreate, token: str, db: Session = Depends(get_db)):
+async def add_favorite(favorite_data: FavoriteCreate, current_user_id: str = Depends(limited_writer("favorites")), db: AsyncSession = Depends(get_db)):
     favorite = FavoriteMessage(
-        user_id=token,
+        user_id=current_user_id,
         type=favorite_data.type,
         text=favorite_data.text,
         file_url=favorite_data.file_url,
         voice_url=favorite_data.voice_url,
-        orig=json.dumps(favorite_data.orig) if favorite_data.orig else None
+        orig=favorite_data.orig or None
     )
     
-    db.add(favorite)
-    db.commit()
+    async def insert_favorite(session):
+        session.add(favorite)
+        await bump_versions(session, version_key("favorites", current_user_id))
+
+    await run_write(insert_favorite, db)
     
-    return {"status": "ok"}
+    return {"status": "ok", "id": favorite.id}
+
+@api_router.post("/favorites/bulk")
+async def bulk_update_favorites(update_data: FavoriteBulkUpdate, current_user_id: str = Depends(limited_writer("favorites")), db: AsyncSession = Depends(get_db)):
+    favorites = [
+        FavoriteMessage(
+            user_id=current_user_id,
+            type=item.type,
+            text=item.text,
+            file_url=item.file_url,
+            voice_url=item.voice_url,
+            orig=item.orig or None
+        )
+        for item in update_data.add
+    ]
+
+    async def apply(session):
+        session.add_all(favorites)
+        await bump_versions(session, version_key("favorites", current_user_id))
+        if not update_data.remove:
+            return 0
+        result = await session.execute(
+            delete(FavoriteMessage).where(
+                FavoriteMessage.user_id == current_user_id, FavoriteMessage.id.in_(update_data.remove)
+            )
+        )
+        return result.rowcount
+
+    removed = await run_write(apply, db)
+
+    return {"added": [favorite.id for favorite in favorites], "removed": removed}
 
 @api_router.post("/upload")
-async def upload_file(file: UploadFile = File(...), token: str = "", db: Session = Depends(get_db)):
-    if not token:
-        raise HTTPException(status_code=401, detail="Нет токена")
-    
-    filename = f"{int(time.time())}_{file.filename}"
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    url = f"/static/uploads/{filename}"
+async def upload_file(file: UploadFile = File(...), current_user_id: str = Depends(limited_writer("upload")), db: AsyncSession = Depends(get_db)):
+    stored = await store_upload(iter_upload_file(file), file.filename)
+    url = stored["url"]
     
     # Update user avatar if it's an image
     if file.content_type and file.content_type.startswith('image/'):
-        user = db.query(User).filter(User.id == token).first()
-        if user:
-            user.avatar = url
-            db.commit()
+        async def set_avatar(session):
+            result = await session.execute(
+                update(User).where(User.id == current_user_id).values(avatar=url, avatar_thumbnails=None)
+            )
+            if result.rowcount:
+                await bump_profile_versions(session, current_user_id)
+            return result.rowcount
+
+        if await run_write(set_avatar, db):
+            schedule_avatar_thumbnails(current_user_id, url)
     
-    return {"url": url}
+    return stored
+
+# Resumable uploads: create a session, PUT raw chunks at increasing offsets,
+# then complete. Progress lives on disk, so an interrupted client asks for the
+# current offset and continues from there.
+UPLOAD_SESSION_DIR = os.path.join(PARTIAL_UPLOAD_DIR, "sessions")
+UPLOAD_SESSIONS_PER_USER = int(os.environ.get("UPLOAD_SESSIONS_PER_USER", 20))
+
+def user_upload_dir(user_id):
+    # One directory per user, so the open sessions of a user are a single listdir
+    return os.path.join(UPLOAD_SESSION_DIR, user_id)
+
+def upload_session_paths(upload_id, user_id):
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    base = os.path.join(user_upload_dir(user_id), upload_id)
+    return base, base + ".json"
+
+def count_upload_sessions(user_id):
+    try:
+        return sum(name.endswith(".json") for name in os.listdir(user_upload_dir(user_id)))
+    except FileNotFoundError:
+        return 0
+
+def load_upload_session(upload_id, user_id):
+    data_path, meta_path = upload_session_paths(upload_id, user_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    if meta["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+    return data_path, meta_path, meta
+
+def upload_offset(data_path):
+    try:
+        return os.path.getsize(data_path)
+    except FileNotFoundError:
+        # Completed or swept while this request waited
+        raise HTTPException(status_code=404, detail="Загрузка не найдена")
+
+upload_locks = {}
+
+class PartialUploadSweeper:
+    """Deletes upload leftovers nobody has touched for `ttl` seconds.
+
+    That is resumable sessions the client abandoned, with their locks, and
+    temporary files of /api/upload requests that died mid-stream. A session's
+    data file is appended to by every chunk, so its mtime is its last activity.
+    """
+
+    def __init__(self, ttl, interval):
+        self.ttl = ttl
+        self.interval = interval
+        self.task = None
+        self.removed = 0
+
+    def stale_files(self):
+        cutoff = time.time() - self.ttl
+        stale = {}
+        for directory, _, names in os.walk(PARTIAL_UPLOAD_DIR):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                key = name.removesuffix(".json")
+                # A session is as fresh as the newer of its two files
+                stale.setdefault(key, []).append((path, mtime))
+        return {
+            key: [path for path, _ in files]
+            for key, files in stale.items() if max(mtime for _, mtime in files) < cutoff
+        }
+
+    async def sweep(self):
+        stale = await asyncio.to_thread(self.stale_files)
+        for key, paths in stale.items():
+            lock = upload_locks.get(key)
+            if lock is not None and lock.locked():
+                continue
+            upload_locks.pop(key, None)
+            for path in paths:
+                try:
+                    await asyncio.to_thread(os.remove, path)
+                    self.removed += 1
+                except FileNotFoundError:
+                    pass
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Failed to sweep partial uploads")
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+
+upload_sweeper = PartialUploadSweeper(
+    ttl=float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600)),
+    interval=float(os.environ.get("UPLOAD_SWEEP_INTERVAL", 3600)),
+)
+
+@api_router.post("/uploads")
+async def create_upload_session(session_data: UploadSessionCreate, current_user_id: str = Depends(limited_writer("upload"))):
+    if session_data.size is not None and not 0 <= session_data.size <= MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="Файл слишком большой")
+
+    if await asyncio.to_thread(count_upload_sessions, current_user_id) >= UPLOAD_SESSIONS_PER_USER:
+        raise HTTPException(status_code=429, detail="Слишком много незавершённых загрузок")
+
+    upload_id = uuid.uuid4().hex
+    data_path, meta_path = upload_session_paths(upload_id, current_user_id)
+    meta = {"user_id": current_user_id, **session_data.model_dump()}
+    def create():
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        open(data_path, "wb").close()
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+    await asyncio.to_thread(create)
+
+    return {"upload_id": upload_id, "offset": 0, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload_session(upload_id: str, current_user_id: str = Depends(get_current_user_id)):
+    data_path, _, meta = load_upload_session(upload_id, current_user_id)
+    return {"upload_id": upload_id, "offset": upload_offset(data_path), "size": meta["size"]}
+
+@api_router.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request, current_user_id: str = Depends(get_current_user_id)):
+    data_path, _, meta = load_upload_session(upload_id, current_user_id)
+    limit = meta["size"] if meta["size"] is not None else MAX_UPLOAD_SIZE
+
+    lock = upload_locks.setdefault(upload_id, asyncio.Lock())
+    async with lock:
+        current = upload_offset(data_path)
+        if offset != current:
+            # The client lost track (e.g. a retried chunk); tell it where to resume
+            return JSONResponse(status_code=409, content={"detail": "Неверное смещение", "offset": current})
+
+        handle = await asyncio.to_thread(open, data_path, "ab")
+        try:
+            size = await write_chunks(handle, request.stream(), current, limit)
+        finally:
+            await asyncio.to_thread(handle.close)
+
+    return {"upload_id": upload_id, "offset": size}
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, current_user_id: str = Depends(get_current_user_id)):
+    data_path, meta_path, meta = load_upload_session(upload_id, current_user_id)
+
+    async with upload_locks.setdefault(upload_id, asyncio.Lock()):
+        # A concurrent complete may have finished the session while this one waited
+        if not os.path.exists(meta_path):
+            raise HTTPException(status_code=404, detail="Загрузка не найдена")
+        size = upload_offset(data_path)
+        if meta["size"] is not None and size != meta["size"]:
+            return JSONResponse(status_code=409, content={"detail": "Загрузка не завершена", "offset": size})
+
+        sha256 = await asyncio.to_thread(hash_file, data_path)
+        name = sha256 + upload_extension(meta["filename"])
+        await upload_storage.save_file(data_path, name)
+        os.remove(meta_path)
+    upload_locks.pop(upload_id, None)
+
+    return {"url": upload_storage.url(name), "size": size, "sha256": sha256}
+
+@api_router.get("/storage")
+async def get_storage_options(current_user_id: str = Depends(get_current_user_id)):
+    # Clients skip hashing for /uploads/direct when the backend can't presign
+    return {"direct_uploads": upload_storage.direct_uploads, "max_upload_size": MAX_UPLOAD_SIZE}
+
+@api_router.post("/uploads/direct")
+async def create_direct_upload(upload_data: DirectUploadCreate, current_user_id: str = Depends(limited_writer("upload"))):
+    """Presign a PUT straight to object storage, so the bytes skip the API workers.
+
+    The object is named after the client's hash and the storage checks it.
+    Whether that content is stored already is not reported, since it could
+    tell the caller what other users uploaded; putting the same bytes again
+    leaves the object as it was.
+    """
+    if upload_data.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="Файл слишком большой")
+    name = upload_data.sha256 + upload_extension(upload_data.filename)
+    upload = upload_storage.presign_upload(name, upload_data.size, upload_data.sha256, upload_data.content_type)
+    if upload is None:
+        raise HTTPException(status_code=501, detail="Прямая загрузка не поддерживается")
+    return {"url": upload_storage.url(name), "upload": upload}
+
+@api_router.get("/files/{name:path}")
+async def get_file(name: str):
+    # Public like /static: names are content hashes, so they can't be guessed
+    if not STORED_NAME.fullmatch(name):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return await upload_storage.download_response(name)
+
+@api_router.get("/avatars/{user_id}")
+async def get_avatar(user_id: str, size: int = 128, current_user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)):
+    user = await load_user(db, user_id, await load_version(db, version_key("profile", user_id)))
+    if not user or not user["avatar"]:
+        raise HTTPException(status_code=404, detail="Аватар не найден")
+
+    variants = user["avatar_thumbnails"]
+    if variants:
+        # Smallest variant that is at least the requested size
+        chosen = next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZES[-1])
+        return RedirectResponse(variants[str(chosen)], headers={"Cache-Control": "private, max-age=300"})
+
+    # Thumbnails aren't ready (or predate the pipeline): serve the original meanwhile
+    schedule_avatar_thumbnails(user_id, user["avatar"])
+    return RedirectResponse(user["avatar"], headers={"Cache-Control": "no-cache"})
 
 @api_router.post("/update_profile")
-async def update_profile(profile_data: ProfileUpdate, token: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == token).first()
+async def update_profile(profile_data: ProfileUpdate, current_user_id: str = Depends(get_current_user_id), db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(User).where(User.id == current_user_id))
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     
     # Check if username is already taken
-    existing_user = db.query(User).filter(
+    existing_user = await db.scalar(select(User).where(
         User.username == profile_data.new_username,
-        User.id != token
-    ).first()
+        User.id != current_user_id
+    ))
     
     if existing_user:
         raise HTTPException(status_code=400, detail="Имя пользователя уже занято")
     
-    user.username = profile_data.new_username
-    db.commit()
+    async def rename(session):
+        await session.execute(
+            update(User).where(User.id == current_user_id).values(username=profile_data.new_username)
+        )
+        await bump_profile_versions(session, current_user_id)
+
+    await run_write(rename, db)
     
     return {"ok": True}
 
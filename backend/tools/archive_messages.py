@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Move old messages out of the messages table into the archive
+
+Every conversation's messages older than --older-than-days (and read) are
+appended to the conversation's compressed segment file under
+MESSAGE_ARCHIVE_DIR, and deleted from the table in the same transaction that
+indexes them. GET /api/messages keeps paging into the archive, so clients
+see the same history. Uses the server's database settings
+(SQLALCHEMY_DATABASE_URL, SQLITE_MODE) and can run while the server does.
+
+Archived messages no longer show up in /api/sync. On SQLite they stay in
+message search; on PostgreSQL search only covers the table.
+
+    python backend/tools/archive_messages.py --older-than-days 180
+    python backend/tools/archive_messages.py --older-than-days 365 --segment-size 2000 --vacuum
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import select, text
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+async def archive(server, older_than, segment_size, vacuum):
+    cutoff = datetime.utcnow() - older_than
+    # One row per pair: conversations holds both sides, and a self-chat's single row
+    async with server.AsyncSessionLocal() as db:
+        pairs = (await db.execute(
+            select(server.Conversation.user_id, server.Conversation.peer_id)
+            .where(server.Conversation.user_id <= server.Conversation.peer_id)
+        )).all()
+
+    start = time.perf_counter()
+    archived = conversations = 0
+    for i, (user_id, peer_id) in enumerate(pairs, 1):
+        moved = await server.archive_conversation(user_id, peer_id, cutoff, segment_size)
+        if moved:
+            archived += moved
+            conversations += 1
+        if i % 1000 == 0 or i == len(pairs):
+            print(f"{i}/{len(pairs)} conversations: {archived} messages archived", file=sys.stderr, flush=True)
+    if server.db_writer is not None:
+        await server.db_writer.stop()
+
+    if vacuum and server.engine.dialect.name == "sqlite":
+        # Gives the freed pages back to the filesystem; takes the write lock for the duration
+        with server.engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    await server.async_engine.dispose()
+    await server.write_engine.dispose()
+
+    return {
+        "cutoff": cutoff.isoformat(),
+        "conversations": conversations,
+        "messages": archived,
+        "seconds": round(time.perf_counter() - start, 3),
+        "archive_dir": server.MESSAGE_ARCHIVE_DIR,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--older-than-days", type=float, required=True, help="archive messages older than this")
+    parser.add_argument("--segment-size", type=int, default=1000, help="messages per compressed block")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM a SQLite database afterwards to shrink the file")
+    args = parser.parse_args()
+    if args.segment_size < 1:
+        parser.error("--segment-size must be positive")
+
+    # Resolve the default ./messenger.db the way the server does when started from backend/
+    os.chdir(BACKEND_DIR)
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    server.run_migrations()
+
+    result = asyncio.run(archive(server, timedelta(days=args.older_than_days), args.segment_size, args.vacuum))
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
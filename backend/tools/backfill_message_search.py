@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Index existing messages for full-text search
+
+Migration 0005 indexes every message in the table and its triggers keep
+the index current, so this is only needed for history the index lacks:
+messages archived before migration 0006, or a database whose index was
+dropped or damaged. It walks messages in rowid order and indexes whatever
+is missing, one batch per transaction, so the server can keep writing
+meanwhile. Index rows are keyed
+on the message id (through message_search_keys), so rerunning it is safe:
+indexed messages are skipped, and an interrupted run picks up where it
+stopped.
+
+Archived messages are indexed from their segment files, one segment per
+transaction; segments archived since migration 0006 are indexed already and
+skipped.
+
+    python backend/tools/backfill_message_search.py --database backend/messenger.db --batch-size 5000
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# The rowid only drives the walk; what gets indexed is keyed on messages.id
+BACKFILL_KEYS = """
+    INSERT INTO message_search_keys (message_id)
+    SELECT m.id FROM messages m
+    WHERE m.rowid > ? AND m.rowid <= ?
+      AND NOT EXISTS (SELECT 1 FROM message_search_keys k WHERE k.message_id = m.id)
+"""
+
+BACKFILL_BATCH = """
+    INSERT INTO message_search (rowid, message_id, text, participants)
+    SELECT k.docid, m.id, m.text, replace(m.sender_id || ' ' || m.receiver_id, '-', '')
+    FROM messages m JOIN message_search_keys k ON k.message_id = m.id
+    WHERE m.rowid > ? AND m.rowid <= ?
+      AND NOT EXISTS (SELECT 1 FROM message_search s WHERE s.rowid = k.docid)
+"""
+
+INDEX_ARCHIVED = """
+    INSERT INTO message_search (rowid, message_id, text, participants)
+    VALUES (?, ?, ?, replace(? || ' ' || ?, '-', ''))
+"""
+
+def backfill_archive(conn, archive_dir):
+    """Index archived messages the delete trigger dropped before migration 0006; return how many."""
+    indexed = 0
+    segments = conn.execute("SELECT id, file, offset, length, last_id FROM archive_segments ORDER BY id").fetchall()
+    for segment_id, file, offset, length, last_id in segments:
+        # A segment is indexed in one transaction, so its last message tells for all of them
+        if conn.execute("SELECT 1 FROM message_search_keys WHERE message_id = ?", (last_id,)).fetchone():
+            continue
+        with open(os.path.join(archive_dir, file), "rb") as f:
+            f.seek(offset)
+            block = [json.loads(line) for line in zlib.decompress(f.read(length)).splitlines()]
+        with conn:
+            for message in block:
+                key = conn.execute(
+                    "INSERT INTO message_search_keys (message_id, segment_id) VALUES (?, ?) "
+                    "ON CONFLICT (message_id) DO NOTHING",
+                    (message["id"], segment_id),
+                )
+                if key.rowcount:
+                    conn.execute(INDEX_ARCHIVED, (key.lastrowid, message["id"], message["text"], message["sender_id"], message["receiver_id"]))
+                    indexed += 1
+        print(f"segment {segment_id}: {indexed} archived messages indexed", flush=True)
+    return indexed
+
+def backfill(database, batch_size, busy_timeout, archive_dir):
+    conn = sqlite3.connect(database, timeout=busy_timeout)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_search_keys'").fetchone() is None:
+            raise SystemExit("message_search does not exist; run `alembic upgrade head` first")
+
+        last_rowid = conn.execute("SELECT coalesce(max(rowid), 0) FROM messages").fetchone()[0]
+        position = 0
+        indexed = 0
+        start = time.perf_counter()
+        while position < last_rowid:
+            upper = position + batch_size
+            with conn:
+                conn.execute(BACKFILL_KEYS, (position, upper))
+                indexed += conn.execute(BACKFILL_BATCH, (position, upper)).rowcount
+            position = upper
+            print(f"rowid {min(position, last_rowid)}/{last_rowid}: {indexed} indexed", flush=True)
+        indexed += backfill_archive(conn, archive_dir)
+
+        with conn:
+            conn.execute("INSERT INTO message_search (message_search) VALUES ('optimize')")
+        print(f"Done: {indexed} messages indexed in {time.perf_counter() - start:.1f}s")
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=str(BACKEND_DIR / "messenger.db"), help="SQLite database file")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rowids per transaction")
+    parser.add_argument("--busy-timeout", type=float, default=30, help="seconds to wait for the server's write lock")
+    parser.add_argument(
+        "--archive-dir", default=os.environ.get("MESSAGE_ARCHIVE_DIR", str(BACKEND_DIR / "archive")),
+        help="the server's MESSAGE_ARCHIVE_DIR",
+    )
+    args = parser.parse_args()
+
+    if not Path(args.database).is_file():
+        parser.error(f"{args.database} does not exist")
+    backfill(args.database, args.batch_size, args.busy_timeout, args.archive_dir)
+
+if __name__ == "__main__":
+    main()
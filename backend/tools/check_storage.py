@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Round-trip check of an upload storage backend
+
+Stores, reads and presigns objects through the same storage object the
+server builds from UPLOAD_STORAGE_URL and the S3_* settings, then does the
+direct client PUT and GET against the presigned URLs over HTTP. Run it
+against MinIO (or any S3-compatible endpoint) before switching a deployment
+over, or with --moto to start an in-process moto S3 server and bucket
+(moto comes with backend/requirements-dev.txt).
+
+    UPLOAD_STORAGE_URL=s3://messenger/uploads S3_ENDPOINT_URL=http://localhost:9000 \\
+        AWS_ACCESS_KEY_ID=minioadmin AWS_SECRET_ACCESS_KEY=minioadmin \\
+        python backend/tools/check_storage.py
+    python backend/tools/check_storage.py --moto
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+def start_moto(port, bucket):
+    import boto3
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    os.environ.update(
+        UPLOAD_STORAGE_URL=f"s3://{bucket}/uploads", S3_ENDPOINT_URL=endpoint, S3_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="moto", AWS_SECRET_ACCESS_KEY="moto",
+    )
+    boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1").create_bucket(Bucket=bucket)
+    return server
+
+def absolute(url, base):
+    return url if url.startswith("http") else base + url
+
+async def check(server, base_url):
+    storage = server.upload_storage
+    if isinstance(storage, server.LocalStorage):
+        # Keep check objects out of the real uploads directory
+        storage = server.LocalStorage(tempfile.mkdtemp(prefix="messenger-storage-"))
+    report = {"backend": type(storage).__name__}
+    # Unique content, so nothing of a previous run is found
+    data = f"storage check {uuid.uuid4()}\n".encode() * 64
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    name = sha256 + ".txt"
+    fd, temp_path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    await storage.save_file(temp_path, name)
+    assert await storage.exists(name), "saved object is missing"
+    assert await storage.read(name) == data, "read back different bytes"
+    report["save_file"] = "ok"
+
+    await storage.save_bytes(f"thumbs/{sha256}-1.txt", data)
+    assert await storage.read(f"thumbs/{sha256}-1.txt") == data, "read back different bytes"
+    report["save_bytes"] = "ok"
+
+    direct = bytes(reversed(data))
+    direct_sha256 = hashlib.sha256(direct).hexdigest()
+    upload = storage.presign_upload(direct_sha256 + ".txt", len(direct), direct_sha256, "text/plain")
+    if upload is None:
+        report["presigned"] = "not supported by this backend"
+        return report
+
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.request(upload["method"], upload["url"], content=direct, headers=upload["headers"])
+            response.raise_for_status()
+            redirect = await storage.download_response(direct_sha256 + ".txt")
+            response = await client.get(absolute(redirect.headers["location"], base_url))
+            response.raise_for_status()
+            assert response.content == direct, "presigned GET returned different bytes"
+            report["presigned_put"] = report["presigned_get"] = "ok"
+            report["content_type"] = response.headers.get("content-type")
+            report["cache_control"] = response.headers.get("cache-control")
+    finally:
+        for key in (name, f"thumbs/{sha256}-1.txt", direct_sha256 + ".txt"):
+            await asyncio.to_thread(storage.client.delete_object, Bucket=storage.bucket, Key=storage.key(key))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--moto", action="store_true", help="run against an in-process moto S3 server")
+    parser.add_argument("--moto-port", type=int, default=5055, help="port for the moto server")
+    parser.add_argument("--bucket", default="messenger-check", help="bucket to create with --moto")
+    parser.add_argument("--base-url", default="http://localhost:8001", help="API origin for relative download URLs")
+    args = parser.parse_args()
+
+    moto_server = start_moto(args.moto_port, args.bucket) if args.moto else None
+    # server.py opens ./messenger.db, so import it from a throwaway directory
+    os.chdir(tempfile.mkdtemp(prefix="messenger-storage-"))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    try:
+        print(json.dumps(asyncio.run(check(server, args.base_url)), indent=2))
+    finally:
+        if moto_server:
+            moto_server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,7 @@ const Messenger = () => {
   const { user, logout, token, API, fetchUserProfile } = useAuth();
   const [selectedChat, setSelectedChat] = useState(null);
   const [chats, setChats] = useState([]);
+  const [chatPreviews, setChatPreviews] = useState({});
   const [messages, setMessages] = useState([]);
   const [favorites, setFavorites] = useState([]);
   const [newMessage, setNewMessage] = useState('');
@@ -52,12 +53,27 @@ const Messenger = () => {
   const fileInputRef = useRef(null);
   const avatarInputRef = useRef(null);
   const searchInputRef = useRef(null);
+  const syncCursorRef = useRef(null);
+  const syncMessagesRef = useRef(null);
+  const storageRef = useRef(null);
+  const olderCursorRef = useRef(null);
+  const keepScrollRef = useRef(false);
+  const [hasOlder, setHasOlder] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const favoritesCursorRef = useRef(null);
+  const [hasMoreFavorites, setHasMoreFavorites] = useState(false);
+  const [loadingFavorites, setLoadingFavorites] = useState(false);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   };
 
   useEffect(() => {
+    // Подгрузка старых сообщений не должна уводить в конец чата
+    if (keepScrollRef.current) {
+      keepScrollRef.current = false;
+      return;
+    }
     scrollToBottom();
   }, [messages]);
 
@@ -102,15 +118,53 @@ const Messenger = () => {
     const interval = setInterval(() => {
       if (activeTab === 'chats') {
         loadUnreadCounts();
+        syncMessages();
       }
     }, 10000); // каждые 10 секунд
 
     return () => clearInterval(interval);
-  }, [activeTab]);
+  }, [activeTab, selectedChat]);
+
+  // Push-канал: сервер сообщает о новых сообщениях и прочтении
+  useEffect(() => {
+    if (!token) return;
+
+    const socket = new WebSocket(`${API.replace(/^http/, 'ws').replace(/\/api$/, '')}/ws?token=${encodeURIComponent(token)}`);
+    socket.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'message' || data.type === 'read') {
+        syncMessagesRef.current?.();
+      }
+    };
+    const heartbeat = setInterval(() => {
+      if (socket.readyState === WebSocket.OPEN) {
+        socket.send('ping');
+      }
+    }, 30000);
+
+    return () => {
+      clearInterval(heartbeat);
+      socket.close();
+    };
+  }, [token]);
 
-  const loadChats = () => {
+  // Список чатов приходит с сервера; локальный список хранит ещё пустые чаты
+  const loadChats = async () => {
     const savedChats = JSON.parse(localStorage.getItem('chatsList') || '[]');
     setChats(savedChats);
+    if (!token) return;
+
+    try {
+      const response = await axios.get(`${API}/conversations`, {
+        params: { token }
+      });
+      const conversations = response.data.conversations || [];
+      const serverChats = conversations.map(c => c.peer_id);
+      saveChats([...serverChats, ...savedChats.filter(chat => !serverChats.includes(chat))]);
+      setChatPreviews(Object.fromEntries(conversations.map(c => [c.peer_id, c.last_message.text])));
+    } catch (error) {
+      console.error('Error loading chats:', error);
+    }
   };
 
   const saveChats = (chatsList) => {
@@ -121,33 +175,92 @@ const Messenger = () => {
   const loadUnreadCounts = async () => {
     if (!token) return;
     try {
-      const response = await axios.get(`${API}/users`, {
+      const response = await axios.get(`${API}/unread_counts`, {
         params: { token }
       });
-      // Mock unread counts since the API doesn't support this yet
-      setUnreadCounts({});
+      setUnreadCounts(response.data.counts || {});
     } catch (error) {
       console.error('Error loading unread counts:', error);
     }
   };
 
+  // Format messages to match expected structure
+  const formatMessage = (msg) => ({
+    text: msg.text,
+    from: msg.sender_id === user?.user_id ? user?.nick : selectedChat,
+    timestamp: new Date(msg.timestamp).getTime() / 1000,
+    id: msg.id
+  });
+
+  // Забрать только изменения с прошлой синхронизации
+  const syncMessages = async () => {
+    if (!token) return;
+
+    try {
+      if (syncCursorRef.current === null) {
+        const response = await axios.get(`${API}/sync`, { params: { token } });
+        syncCursorRef.current = response.data.cursor;
+        return;
+      }
+
+      let hasMore = true;
+      while (hasMore) {
+        const response = await axios.get(`${API}/sync`, {
+          params: { token, since: syncCursorRef.current }
+        });
+        syncCursorRef.current = response.data.cursor;
+        hasMore = response.data.has_more;
+
+        const changed = (response.data.messages || []).filter(msg =>
+          msg.sender_id === selectedChat || msg.receiver_id === selectedChat
+        );
+        if (changed.length) {
+          markRead(changed.filter(msg => msg.sender_id === selectedChat && !msg.is_read));
+          setMessages(prev => {
+            const byId = new Map(prev.map(m => [m.id, m]));
+            changed.forEach(msg => byId.set(msg.id, formatMessage(msg)));
+            return Array.from(byId.values()).sort((a, b) => a.timestamp - b.timestamp);
+          });
+        }
+      }
+    } catch (error) {
+      console.error('Error syncing messages:', error);
+    }
+  };
+
+  syncMessagesRef.current = syncMessages;
+
+  // Отметить прочитанным всё до последнего входящего сообщения
+  const markRead = async (incoming) => {
+    const last = incoming[incoming.length - 1];
+    if (!last) return;
+
+    try {
+      await axios.post(`${API}/messages/${selectedChat}/read`, { message_id: last.id }, {
+        params: { token }
+      });
+    } catch (error) {
+      console.error('Error marking messages read:', error);
+    }
+  };
+
   const loadMessages = async () => {
     if (!selectedChat || selectedChat === 'Избранное') return;
 
     try {
+      if (syncCursorRef.current === null) {
+        await syncMessages();
+      }
+
       const response = await axios.get(`${API}/messages/${selectedChat}`, {
         params: { token }
       });
       
-      // Format messages to match expected structure
-      const formattedMessages = (response.data.messages || []).map(msg => ({
-        text: msg.text,
-        from: msg.sender_id === token ? user?.nick : selectedChat,
-        timestamp: new Date(msg.timestamp).getTime() / 1000,
-        id: msg.id
-      }));
-      
-      setMessages(formattedMessages);
+      const loaded = response.data.messages || [];
+      olderCursorRef.current = response.data.next_before;
+      setHasOlder(Boolean(response.data.next_before));
+      setMessages(loaded.map(formatMessage));
+      markRead(loaded.filter(msg => msg.sender_id === selectedChat && !msg.is_read));
 
       // Очистить счетчик непрочитанных для этого чата
       if (unreadCounts[selectedChat]) {
@@ -160,17 +273,78 @@ const Messenger = () => {
     }
   };
 
+  // Подгрузить страницу более старых сообщений перед уже загруженными
+  const loadOlderMessages = async () => {
+    if (!selectedChat || !olderCursorRef.current || loadingOlder) return;
+
+    setLoadingOlder(true);
+    try {
+      const response = await axios.get(`${API}/messages/${selectedChat}`, {
+        params: { token, before: olderCursorRef.current }
+      });
+      const older = (response.data.messages || []).map(formatMessage);
+      olderCursorRef.current = response.data.next_before;
+      setHasOlder(Boolean(response.data.next_before));
+      keepScrollRef.current = true;
+      setMessages(prev => {
+        const known = new Set(prev.map(m => m.id));
+        return [...older.filter(m => !known.has(m.id)), ...prev];
+      });
+    } catch (error) {
+      console.error('Error loading older messages:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
   const loadFavorites = async () => {
     try {
       const response = await axios.get(`${API}/favorites`, {
         params: { token }
       });
+      favoritesCursorRef.current = response.data.next_before;
+      setHasMoreFavorites(Boolean(response.data.next_before));
       setFavorites(response.data.favorites || []);
     } catch (error) {
       console.error('Error loading favorites:', error);
     }
   };
 
+  // Дописать следующую страницу более старых избранных сообщений
+  const loadMoreFavorites = async () => {
+    if (!favoritesCursorRef.current || loadingFavorites) return;
+
+    setLoadingFavorites(true);
+    try {
+      const response = await axios.get(`${API}/favorites`, {
+        params: { token, before: favoritesCursorRef.current }
+      });
+      const older = response.data.favorites || [];
+      favoritesCursorRef.current = response.data.next_before;
+      setHasMoreFavorites(Boolean(response.data.next_before));
+      setFavorites(prev => {
+        const known = new Set(prev.map(fav => fav.id));
+        return [...prev, ...older.filter(fav => !known.has(fav.id))];
+      });
+    } catch (error) {
+      console.error('Error loading favorites:', error);
+    } finally {
+      setLoadingFavorites(false);
+    }
+  };
+
+  const renderMoreFavoritesButton = () => hasMoreFavorites && (
+    <div className="flex justify-center">
+      <button
+        onClick={loadMoreFavorites}
+        disabled={loadingFavorites}
+        className="px-4 py-1 text-sm text-blue-600 hover:bg-blue-50 rounded-full disabled:opacity-50"
+      >
+        {loadingFavorites ? 'Загрузка...' : 'Показать ещё'}
+      </button>
+    </div>
+  );
+
   const searchUsers = async (query) => {
     if (!query.trim()) {
       setSearchResults([]);
@@ -178,20 +352,27 @@ const Messenger = () => {
     }
 
     try {
-      const response = await axios.get(`${API}/users`, {
-        params: { token }
+      const response = await axios.get(`${API}/users/search`, {
+        params: { token, q: query }
       });
       
-      // Filter users by username containing query
-      const filtered = (response.data.users || []).filter(u => 
-        u.username.toLowerCase().includes(query.toLowerCase())
-      );
-      
-      setSearchResults(filtered.map(u => ({
-        ...u,
-        nick: u.username,
-        online: true // Mock online status
-      })));
+      const users = response.data.users || [];
+      setSearchResults(users.map(u => ({ ...u, nick: u.username, online: false })));
+
+      if (users.length > 0) {
+        const presenceResponse = await axios.post(`${API}/presence`, {
+          user_ids: users.map(u => u.id)
+        }, {
+          params: { token }
+        });
+        const presence = presenceResponse.data.presence || {};
+        setSearchResults(users.map(u => ({
+          ...u,
+          nick: u.username,
+          online: presence[u.id]?.online || false,
+          last_online: presence[u.id] ? presence[u.id].last_online : u.last_online
+        })));
+      }
     } catch (error) {
       setSearchResults([]);
       console.error('Error searching users:', error);
@@ -216,7 +397,7 @@ const Messenger = () => {
       }
 
       setNewMessage('');
-      await loadMessages();
+      await syncMessages();
     } catch (error) {
       console.error('Error sending message:', error);
     }
@@ -244,24 +425,64 @@ const Messenger = () => {
     }
   };
 
+  // Возможности хранилища запрашиваются один раз
+  const getStorageOptions = () => {
+    if (!storageRef.current) {
+      storageRef.current = axios.get(`${API}/storage`, { params: { token } })
+        .then(response => response.data)
+        .catch(() => {
+          storageRef.current = null;
+          return { direct_uploads: false };
+        });
+    }
+    return storageRef.current;
+  };
+
+  // Если хранилище выдаёт подписанные ссылки, файл идёт в него напрямую, минуя сервер
+  const uploadFile = async (file) => {
+    const storage = await getStorageOptions();
+    if (storage.direct_uploads && window.crypto?.subtle) {
+      const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+      const sha256 = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+      try {
+        const response = await axios.post(`${API}/uploads/direct`, {
+          filename: file.name,
+          size: file.size,
+          sha256,
+          content_type: file.type || null
+        }, {
+          params: { token }
+        });
+        const { method, url, headers } = response.data.upload;
+        await axios({ method, url, headers, data: file });
+        return response.data.url;
+      } catch (error) {
+        // 501: прямая загрузка не поддерживается, загружаем через сервер
+        if (error.response?.status !== 501) throw error;
+      }
+    }
+
+    const formData = new FormData();
+    formData.append('file', file);
+    const uploadResponse = await axios.post(`${API}/upload`, formData, {
+      params: { token },
+      headers: { 'Content-Type': 'multipart/form-data' }
+    });
+    return uploadResponse.data.url;
+  };
+
   const handleFileUpload = async (event) => {
     const file = event.target.files[0];
     if (!file) return;
 
     try {
-      const formData = new FormData();
-      formData.append('file', file);
+      const fileUrl = await uploadFile(file);
 
-      const uploadResponse = await axios.post(`${API}/upload`, formData, {
-        params: { token },
-        headers: { 'Content-Type': 'multipart/form-data' }
-      });
-
-      if (uploadResponse.data.url) {
+      if (fileUrl) {
         if (selectedChat === 'Избранное') {
           await axios.post(`${API}/favorites`, {
             type: 'file',
-            file_url: uploadResponse.data.url,
+            file_url: fileUrl,
             text: `Файл: ${file.name}`
           }, {
             params: { token }
@@ -270,7 +491,7 @@ const Messenger = () => {
           await loadFavorites();
         } else {
           // Отправить файл как сообщение (для будущей реализации)
-          console.log('File uploaded:', uploadResponse.data.url);
+          console.log('File uploaded:', fileUrl);
         }
       }
     } catch (error) {
@@ -579,7 +800,7 @@ const Messenger = () => {
                           </span>
                           {!result.online && result.last_online && (
                             <span>
-                              • {new Date(result.last_online * 1000).toLocaleDateString('ru-RU')}
+                              • {new Date(result.last_online).toLocaleDateString('ru-RU')}
                             </span>
                           )}
                         </div>
@@ -679,7 +900,7 @@ const Messenger = () => {
                           </span>
                         )}
                       </div>
-                      <p className="text-sm text-gray-500">Нажмите для открытия чата</p>
+                      <p className="text-sm text-gray-500 truncate">{chatPreviews[chat] || 'Нажмите для открытия чата'}</p>
                     </div>
                   </div>
                 </div>
@@ -726,6 +947,7 @@ const Messenger = () => {
                       </p>
                     </div>
                   ))}
+                  {renderMoreFavoritesButton()}
                 </div>
               )}
             </div>
@@ -839,6 +1061,7 @@ const Messenger = () => {
                 ) : (
                   <>
                     {favorites.map((fav, index) => renderFavoriteMessage(fav, index))}
+                    {renderMoreFavoritesButton()}
                     <div ref={messagesEndRef} />
                   </>
                 )
@@ -859,6 +1082,17 @@ const Messenger = () => {
                   </div>
                 ) : (
                   <>
+                    {hasOlder && (
+                      <div className="flex justify-center">
+                        <button
+                          onClick={loadOlderMessages}
+                          disabled={loadingOlder}
+                          className="px-4 py-1 text-sm text-blue-600 hover:bg-blue-50 rounded-full disabled:opacity-50"
+                        >
+                          {loadingOlder ? 'Загрузка...' : 'Загрузить предыдущие'}
+                        </button>
+                      </div>
+                    )}
                     {messages.map((message, index) => renderMessage(message, index))}
                     <div ref={messagesEndRef} />
                   </>
@@ -24,7 +24,8 @@ export const AuthProvider = ({ children }) => {
         const savedUser = localStorage.getItem('user');
         const savedToken = localStorage.getItem('token');
         
-        if (savedUser && savedToken) {
+        // Older builds stored the raw user id as the token; it is no longer accepted
+        if (savedUser && savedToken && savedToken.split('.').length === 3) {
             try {
                 const userData = JSON.parse(savedUser);
                 setUser(userData);
@@ -33,6 +34,9 @@ export const AuthProvider = ({ children }) => {
                 localStorage.removeItem('user');
                 localStorage.removeItem('token');
             }
+        } else {
+            localStorage.removeItem('user');
+            localStorage.removeItem('token');
         }
         setLoading(false);
     }, []);
@@ -45,7 +49,7 @@ export const AuthProvider = ({ children }) => {
             });
             
             const userData = response.data;
-            const userToken = userData.user_id; // Using user_id as token
+            const userToken = userData.token;
             
             // Set nick as username for compatibility
             const fullUserData = {
@@ -77,7 +81,7 @@ export const AuthProvider = ({ children }) => {
             });
             
             const userData = response.data;
-            const userToken = userData.user_id; // Using user_id as token
+            const userToken = userData.token;
             
             // Set nick as username for compatibility
             const fullUserData = {
@@ -0,0 +1,58 @@
+"""Fixtures that run the backend app against a throwaway SQLite database.
+
+server.py reads its settings at import, so they are set here first. Writes go
+through the DatabaseWriter (SQLITE_MODE=production), as in deployment.
+"""
+import os
+import secrets
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="messenger-tests-")
+os.environ.update({
+    "SQLALCHEMY_DATABASE_URL": f"sqlite:///{DATA_DIR}/messenger.db",
+    "SQLITE_MODE": "production",
+    "MESSAGE_ARCHIVE_DIR": os.path.join(DATA_DIR, "archive"),
+    "UPLOAD_DIR": os.path.join(DATA_DIR, "uploads"),
+    "PARTIAL_UPLOAD_DIR": os.path.join(DATA_DIR, "partial_uploads"),
+    "JWT_SECRET": secrets.token_hex(32),
+    # The tests send faster than any client would
+    "RATE_LIMIT_MESSAGES": "0,1",
+    "RATE_LIMIT_FAVORITES": "0,1",
+    "RATE_LIMIT_UPLOADS": "0,1",
+})
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(server.app) as client:
+        yield client
+
+
+@pytest.fixture
+def register(client):
+    """Create a user with a unique name; returns (user_id, token)."""
+    def register():
+        name = f"user{uuid.uuid4().hex[:12]}"
+        response = client.post("/api/register", json={"username": name, "email": f"{name}@example.com", "password": "secret"})
+        assert response.status_code == 200, response.text
+        return response.json()["user_id"], response.json()["token"]
+    return register
+
+
+@pytest.fixture
+def send(client):
+    """Send a text message; returns its id."""
+    def send(token, receiver_id, text):
+        response = client.post("/api/messages", params={"token": token}, json={"receiver_id": receiver_id, "text": text})
+        assert response.status_code == 200, response.text
+        return response.json()["id"]
+    return send
@@ -0,0 +1,79 @@
+"""Write admission: per-user token buckets (429) and load shedding (503)."""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def post_message(client, token, receiver_id):
+    return client.post("/api/messages", params={"token": token}, json={"receiver_id": receiver_id, "text": "hi"})
+
+
+def controller(**overrides):
+    settings = dict(max_concurrent=1, max_queue=1, max_wait=0.05, max_writer_queue=1000, retry_after=3)
+    return server.AdmissionController(**{**settings, **overrides})
+
+
+def test_rate_limit_refuses_with_retry_after(client, register, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "messages", (0.5, 2))
+    _, token = register()
+    _, other_token = register()
+    receiver, _ = register()
+
+    responses = [post_message(client, token, receiver) for _ in range(3)]
+
+    assert [r.status_code for r in responses] == [200, 200, 429]
+    assert responses[2].headers["retry-after"] == "2"
+    # Buckets are per user
+    assert post_message(client, other_token, receiver).status_code == 200
+    assert 'rate_limited_total{route="messages"}' in client.get("/metrics").text
+
+
+def test_full_queue_is_shed(client, register, monkeypatch):
+    monkeypatch.setattr(server, "admission", controller(max_concurrent=0, max_queue=0))
+    _, token = register()
+    receiver, _ = register()
+
+    response = post_message(client, token, receiver)
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "3"
+    assert server.admission.stats()["rejected"] == 1
+
+
+@pytest.mark.parametrize("max_queue, reason", [(0, "queue"), (1, "wait")])
+def test_slot_is_refused_while_busy(client, max_queue, reason):
+    admission = controller(max_queue=max_queue)
+
+    async def second_request():
+        async with admission.slot("messages"):
+            with pytest.raises(HTTPException) as refused:
+                async with admission.slot("messages"):
+                    pass
+            return refused.value
+
+    refused = client.portal.call(second_request)
+
+    assert refused.status_code == 503
+    assert admission.stats() == {"in_flight": 0, "queued": 0, "rejected": 1}
+    assert f'admission_rejected_total{{reason="{reason}",route="messages"}}' in client.get("/metrics").text
+
+
+def test_waiting_request_gets_the_freed_slot(client):
+    admission = controller(max_wait=1)
+
+    async def two_requests():
+        order = []
+
+        async def request(name, hold):
+            async with admission.slot("messages"):
+                order.append(name)
+                await asyncio.sleep(hold)
+
+        await asyncio.gather(request("first", 0.05), request("second", 0))
+        return order
+
+    assert client.portal.call(two_requests) == ["first", "second"]
+    assert admission.stats()["rejected"] == 0
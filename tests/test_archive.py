@@ -0,0 +1,114 @@
+"""Paging, export and search across archived segments and the messages table."""
+from datetime import datetime, timedelta
+
+import orjson
+import pytest
+from sqlalchemy import select, update
+
+import server
+
+
+@pytest.fixture
+def archived_chat(client, register, send):
+    """A conversation of 12 messages whose first 8 are archived in blocks of 3."""
+    alice, alice_token = register()
+    bob, bob_token = register()
+    sent = [send(alice_token if i % 2 else bob_token, bob if i % 2 else alice, f"archived banana {i}") for i in range(12)]
+
+    async def archive():
+        async with server.WriteSessionLocal() as db:
+            start = datetime.utcnow() - timedelta(days=400)
+            for i, message_id in enumerate(sent[:8]):
+                await db.execute(update(server.Message).where(server.Message.id == message_id).values(
+                    timestamp=start + timedelta(minutes=i), is_read=True
+                ))
+            await db.commit()
+        return await server.archive_conversation(alice, bob, datetime.utcnow() - timedelta(days=30), 3)
+
+    assert client.portal.call(archive) == 8
+    return alice, alice_token, bob, bob_token, sent
+
+
+def segment_sizes(client, user_id, peer_id):
+    user_low, user_high = server.conversation_pair(user_id, peer_id)
+
+    async def sizes():
+        async with server.AsyncSessionLocal() as db:
+            return (await db.scalars(select(server.ArchiveSegment.message_count).where(
+                server.ArchiveSegment.user_low == user_low, server.ArchiveSegment.user_high == user_high
+            ).order_by(server.ArchiveSegment.id))).all()
+    return client.portal.call(sizes)
+
+
+def export(client, token, since=None):
+    params = {"token": token}
+    if since:
+        params["since"] = since
+    response = client.get("/api/export", params=params)
+    assert response.status_code == 200, response.text
+    return [orjson.loads(line) for line in response.content.splitlines()]
+
+
+@pytest.mark.parametrize("limit", [1, 4, 5, 50])
+def test_page_back_into_archive(client, archived_chat, limit):
+    alice, _, bob, bob_token, sent = archived_chat
+    assert segment_sizes(client, alice, bob) == [3, 3, 2]
+
+    messages, before = [], None
+    while True:
+        params = {"token": bob_token, "limit": limit}
+        if before:
+            params["before"] = before
+        page = client.get(f"/api/messages/{alice}", params=params).json()
+        messages = page["messages"] + messages
+        before = page["next_before"]
+        if not before:
+            break
+
+    assert [m["id"] for m in messages] == sent
+    assert messages[0]["text"] == "archived banana 0"
+
+
+def test_page_forward_out_of_archive(client, archived_chat):
+    alice, _, _, bob_token, sent = archived_chat
+    oldest = client.get(f"/api/messages/{alice}", params={"token": bob_token, "limit": 12}).json()["messages"][0]
+    after = server.encode_cursor(datetime.fromisoformat(oldest["timestamp"]), oldest["id"])
+
+    forward = []
+    while True:
+        page = client.get(f"/api/messages/{alice}", params={"token": bob_token, "after": after, "limit": 3}).json()
+        forward += [m["id"] for m in page["messages"]]
+        after = page["next_after"]
+        if not page["has_more"]:
+            break
+
+    assert forward == sent[1:]
+
+
+def test_export_includes_archive_once(client, archived_chat, send):
+    alice, alice_token, bob, _, sent = archived_chat
+
+    lines = export(client, alice_token)
+    exported = [line["data"]["id"] for line in lines if line["type"] == "message"]
+    trailer = lines[-1]
+
+    assert sorted(exported) == sorted(sent)
+    assert trailer["type"] == "export" and trailer["data"]["messages"] == 12
+
+    # The next export only carries what was sent since
+    newer = send(alice_token, bob, "after the export")
+    lines = export(client, alice_token, trailer["data"]["since"])
+    assert [line["data"]["id"] for line in lines if line["type"] == "message"] == [newer]
+
+
+def test_search_finds_archived_messages(client, archived_chat):
+    alice, _, bob, bob_token, sent = archived_chat
+
+    params = {"token": bob_token, "q": "banana", "peer_id": alice, "limit": 50}
+    results = client.get("/api/search/messages", params=params).json()["results"]
+    by_id = {r["id"]: r for r in results}
+
+    assert sorted(by_id) == sorted(sent)
+    assert by_id[sent[0]]["text"] == "archived banana 0"
+    assert by_id[sent[0]]["sender_id"] == bob
+    assert "<mark>" in by_id[sent[0]]["snippet"]
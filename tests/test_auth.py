@@ -0,0 +1,66 @@
+"""Signed session tokens and the versioned cache of user records."""
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+import server
+
+
+def profile(client, token):
+    return client.get("/api/profile", params={"token": token})
+
+
+def test_login_issues_a_working_token(client):
+    name = f"user{uuid.uuid4().hex[:12]}"
+    credentials = {"email": f"{name}@example.com", "password": "secret"}
+    client.post("/api/register", json={"username": name, **credentials})
+
+    assert client.post("/api/login", json={**credentials, "password": "wrong"}).status_code == 401
+    token = client.post("/api/login", json=credentials).json()["token"]
+
+    assert profile(client, token).json()["username"] == name
+
+
+@pytest.mark.parametrize("make_token", [
+    lambda user_id: "",
+    lambda user_id: "not-a-token",
+    # The old scheme: the user id itself
+    lambda user_id: user_id,
+    lambda user_id: jwt.encode({"sub": user_id, "exp": datetime.utcnow() + timedelta(hours=1)}, "other-secret", algorithm="HS256"),
+    lambda user_id: jwt.encode({"sub": user_id, "exp": datetime.utcnow() - timedelta(seconds=1)}, server.JWT_SECRET, algorithm="HS256"),
+    lambda user_id: jwt.encode({"exp": datetime.utcnow() + timedelta(hours=1)}, server.JWT_SECRET, algorithm="HS256"),
+])
+def test_bad_tokens_are_refused(client, register, make_token):
+    user_id, _ = register()
+
+    assert profile(client, make_token(user_id)).status_code == 401
+
+
+def test_cached_record_serves_until_the_profile_changes(client, register):
+    user_id, token = register()
+    profile(client, token)
+    version, record = server.user_cache.entries[user_id]
+
+    # A record cached at the current version is used without reading the row
+    server.user_cache.put(user_id, version, {**record, "username": "from-cache"})
+    assert profile(client, token).json()["username"] == "from-cache"
+
+    new_name = f"user{uuid.uuid4().hex[:12]}"
+    client.post("/api/update_profile", params={"token": token}, json={"new_username": new_name})
+
+    assert profile(client, token).json()["username"] == new_name
+    assert server.user_cache.entries[user_id][0] > version
+
+
+def test_cache_evicts_least_recently_used():
+    cache = server.UserCache(maxsize=2)
+    cache.put("a", 1, {"id": "a"})
+    cache.put("b", 1, {"id": "b"})
+    cache.get("a", 1)
+    cache.put("c", 1, {"id": "c"})
+
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == {"id": "a"}
+    assert cache.get("a", 2) is None
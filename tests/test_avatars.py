@@ -0,0 +1,38 @@
+"""Avatar thumbnails, including those of avatars stored before content addressing."""
+import io
+import os
+import uuid
+
+from PIL import Image
+
+import server
+
+
+def test_legacy_avatar_thumbnails_are_cached(client, register):
+    user_id, token = register()
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 300), "teal").save(buffer, format="PNG")
+    name = f"{uuid.uuid4()}.png"
+    with open(os.path.join(server.UPLOAD_DIR, name), "wb") as f:
+        f.write(buffer.getvalue())
+    avatar_url = server.upload_storage.url(name)
+
+    async def set_avatar(db):
+        await db.execute(server.update(server.User).where(server.User.id == user_id).values(avatar=avatar_url))
+        await server.bump_profile_versions(db, user_id)
+
+    client.portal.call(server.run_write, set_avatar)
+    client.portal.call(server.generate_avatar_thumbnails, user_id, avatar_url)
+
+    redirect = client.get(f"/api/avatars/{user_id}", params={"token": token, "size": 128}, follow_redirects=False)
+    thumbnail_url = redirect.headers["location"]
+    assert thumbnail_url.endswith(f"/thumbs/{name[:-4]}-128.{server.THUMBNAIL_EXTENSION}")
+
+    thumbnail = client.get(thumbnail_url)
+    assert thumbnail.status_code == 200
+    assert thumbnail.headers["cache-control"] == server.LEGACY_UPLOAD_CACHE_CONTROL
+    assert "last-modified" in thumbnail.headers
+
+    # Once stale it is revalidated, not downloaded again
+    revalidated = client.get(thumbnail_url, headers={"If-None-Match": thumbnail.headers["etag"]})
+    assert revalidated.status_code == 304
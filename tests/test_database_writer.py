@@ -0,0 +1,96 @@
+"""Group commit in the DatabaseWriter, and how a failing batch is retried."""
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+import server
+
+PREFIX = "test-writer:"
+
+
+def names(count):
+    return [f"{PREFIX}{uuid.uuid4().hex}" for _ in range(count)]
+
+
+def counter_job(name, fail=False):
+    """A write job that adds a sync counter, then raises if `fail`."""
+    async def job(session):
+        session.add(server.SyncCounter(name=name, value=1))
+        if fail:
+            raise ValueError(name)
+        return name
+    return job
+
+
+async def write_all(jobs):
+    writer = server.DatabaseWriter(server.WriteSessionLocal, 16)
+    try:
+        # Queued before the writer task first runs, so they make one batch
+        results = await asyncio.gather(*(writer.submit(job) for job in jobs), return_exceptions=True)
+    finally:
+        await writer.stop()
+    async with server.AsyncSessionLocal() as db:
+        stored = set((await db.scalars(select(server.SyncCounter.name).where(
+            server.SyncCounter.name.like(f"{PREFIX}%")
+        ))).all())
+    return writer, results, stored
+
+
+def test_queued_jobs_share_one_commit(client):
+    batch = names(5)
+
+    writer, results, stored = client.portal.call(write_all, [counter_job(name) for name in batch])
+
+    assert results == batch
+    assert set(batch) <= stored
+    assert (writer.batches, writer.jobs, writer.largest_batch) == (1, 5, 5)
+
+
+def test_failing_job_fails_alone(client):
+    batch = names(5)
+    jobs = [counter_job(name, fail=i == 2) for i, name in enumerate(batch)]
+
+    writer, results, stored = client.portal.call(write_all, jobs)
+
+    assert isinstance(results[2], ValueError)
+    assert [r for i, r in enumerate(results) if i != 2] == batch[:2] + batch[3:]
+    # The batch was rolled back and the others committed one by one, without the failed job's row
+    assert set(batch[:2] + batch[3:]) <= stored
+    assert batch[2] not in stored
+    assert (writer.batches, writer.jobs, writer.largest_batch) == (4, 4, 1)
+
+
+def test_commit_failure_is_retried_per_job(client):
+    existing, = names(1)
+    client.portal.call(write_all, [counter_job(existing)])
+    batch = names(3)
+
+    # The duplicate key only fails at commit, after every job has run
+    jobs = [counter_job(batch[0]), counter_job(existing), counter_job(batch[1]), counter_job(batch[2])]
+    writer, results, stored = client.portal.call(write_all, jobs)
+
+    assert isinstance(results[1], IntegrityError)
+    assert [results[0]] + results[2:] == batch
+    assert set(batch) <= stored
+    assert writer.jobs == 3
+
+
+@pytest.mark.parametrize("limit", [1, 3])
+def test_batches_are_capped(client, limit):
+    batch = names(7)
+
+    async def write():
+        writer = server.DatabaseWriter(server.WriteSessionLocal, limit)
+        try:
+            await asyncio.gather(*(writer.submit(counter_job(name)) for name in batch))
+        finally:
+            await writer.stop()
+        return writer
+
+    writer = client.portal.call(write)
+
+    assert writer.largest_batch == limit
+    assert writer.jobs == 7
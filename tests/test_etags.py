@@ -0,0 +1,107 @@
+"""Conditional GETs: database-backed ETags, 304s, and the version bumps behind them."""
+import uuid
+
+from sqlalchemy import update
+
+import server
+
+
+def get(client, path, token, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    return client.get(path, params={"token": token}, headers=headers)
+
+
+def assert_unchanged(client, path, token, etag):
+    response = get(client, path, token, etag)
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert response.content == b""
+
+
+def test_profile_etag_follows_changes(client, register):
+    _, token = register()
+    first = get(client, "/api/profile", token)
+    etag = first.headers["etag"]
+
+    assert first.headers["cache-control"] == "private, no-cache"
+    assert_unchanged(client, "/api/profile", token, etag)
+
+    name = f"renamed{uuid.uuid4().hex[:8]}"
+    assert client.post("/api/update_profile", params={"token": token}, json={"new_username": name}).status_code == 200
+
+    changed = get(client, "/api/profile", token, etag)
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert changed.json()["username"] == name
+
+
+def test_profile_sees_another_workers_change(client, register):
+    user_id, token = register()
+    get(client, "/api/profile", token)  # cached here at the current version
+
+    async def rename_elsewhere(session):
+        # What another worker's rename does: no local cache involved
+        await session.execute(update(server.User).where(server.User.id == user_id).values(username=f"w{user_id[:8]}"))
+        await server.bump_profile_versions(session, user_id)
+
+    client.portal.call(server.run_write, rename_elsewhere)
+
+    assert get(client, "/api/profile", token).json()["username"] == f"w{user_id[:8]}"
+
+
+def test_profile_is_served_from_cache_at_the_same_version(client, register, monkeypatch):
+    _, token = register()
+    get(client, "/api/profile", token)
+    hits = []
+    original = server.user_cache.get
+
+    def recording_get(cached_id, version):
+        record = original(cached_id, version)
+        hits.append(record is not None)
+        return record
+
+    monkeypatch.setattr(server.user_cache, "get", recording_get)
+    get(client, "/api/profile", token)
+
+    assert hits == [True]
+
+
+def test_favorites_etag_bumps_on_add(client, register):
+    _, token = register()
+    etag = get(client, "/api/favorites", token).headers["etag"]
+    assert_unchanged(client, "/api/favorites", token, etag)
+
+    client.post("/api/favorites", params={"token": token}, json={"text": "keep"})
+
+    changed = get(client, "/api/favorites", token, etag)
+    assert changed.status_code == 200 and changed.headers["etag"] != etag
+
+
+def test_messages_etag_bumps_for_both_sides(client, register, send):
+    alice, alice_token = register()
+    bob, bob_token = register()
+    alice_etag = get(client, f"/api/messages/{bob}", alice_token).headers["etag"]
+    bob_etag = get(client, f"/api/messages/{alice}", bob_token).headers["etag"]
+    assert_unchanged(client, f"/api/messages/{bob}", alice_token, alice_etag)
+
+    message_id = send(alice_token, bob, "hello")
+
+    assert get(client, f"/api/messages/{bob}", alice_token, alice_etag).status_code == 200
+    bob_page = get(client, f"/api/messages/{alice}", bob_token, bob_etag)
+    assert bob_page.status_code == 200
+
+    # Reading bumps both sides again: the sender's copy now shows is_read
+    bob_etag = bob_page.headers["etag"]
+    client.post(f"/api/messages/{alice}/read", params={"token": bob_token}, json={"message_id": message_id})
+    client.portal.call(server.read_receipts.flush)
+    assert get(client, f"/api/messages/{alice}", bob_token, bob_etag).status_code == 200
+
+
+def test_users_etag_bumps_on_register(client, register):
+    _, token = register()
+    etag = get(client, "/api/users", token).headers["etag"]
+    assert_unchanged(client, "/api/users", token, etag)
+
+    register()
+
+    assert get(client, "/api/users", token, etag).status_code == 200
@@ -0,0 +1,106 @@
+"""Cursor pagination of messages, favorites and conversations."""
+
+
+def page_back(client, path, token, key, limit):
+    """Follow next_before to the start; returns the items oldest first and the pages seen."""
+    items, pages, before = [], [], None
+    while True:
+        params = {"token": token, "limit": limit}
+        if before:
+            params["before"] = before
+        response = client.get(path, params=params)
+        assert response.status_code == 200, response.text
+        page = response.json()
+        pages.append(page)
+        items = page[key] + items if key == "messages" else items + page[key]
+        before = page["next_before"]
+        if not before:
+            return items, pages
+
+
+def test_messages_page_back_through_both_directions(client, register, send):
+    alice, alice_token = register()
+    bob, bob_token = register()
+    carol, _ = register()
+    sent = [send(alice_token if i % 2 else bob_token, bob if i % 2 else alice, f"m{i}") for i in range(11)]
+    send(alice_token, carol, "elsewhere")
+
+    messages, pages = page_back(client, f"/api/messages/{alice}", bob_token, "messages", 4)
+
+    assert [m["id"] for m in messages] == sent
+    assert [len(p["messages"]) for p in pages] == [4, 4, 3]
+    assert [p["has_more"] for p in pages] == [True, True, False]
+    # Each page is in ascending order, like the whole history
+    assert all(p["messages"] == sorted(p["messages"], key=lambda m: (m["timestamp"], m["id"])) for p in pages)
+
+
+def test_messages_page_forward_with_after(client, register, send):
+    alice, alice_token = register()
+    bob, bob_token = register()
+    sent = [send(alice_token, bob, f"m{i}") for i in range(3)]
+
+    first = client.get(f"/api/messages/{bob}", params={"token": alice_token}).json()
+    assert first["next_before"] is None
+    sent += [send(bob_token, alice, f"m{i}") for i in range(3, 8)]
+
+    forward, after = [], first["next_after"]
+    while True:
+        page = client.get(f"/api/messages/{bob}", params={"token": alice_token, "after": after, "limit": 2}).json()
+        forward += [m["id"] for m in page["messages"]]
+        after = page["next_after"]
+        if not page["has_more"]:
+            break
+
+    assert [m["id"] for m in first["messages"]] + forward == sent
+    assert after == page["next_after"]
+    # Polling past the newest message returns nothing and keeps the cursor
+    idle = client.get(f"/api/messages/{bob}", params={"token": alice_token, "after": after}).json()
+    assert idle["messages"] == [] and idle["next_after"] == after
+
+
+def test_messages_self_chat(client, register, send):
+    alice, alice_token = register()
+    sent = [send(alice_token, alice, f"note {i}") for i in range(5)]
+
+    messages, _ = page_back(client, f"/api/messages/{alice}", alice_token, "messages", 2)
+
+    assert [m["id"] for m in messages] == sent
+
+
+def test_messages_rejects_bad_cursors(client, register):
+    alice, alice_token = register()
+    bob, _ = register()
+
+    both = client.get(f"/api/messages/{bob}", params={"token": alice_token, "before": "x", "after": "y"})
+    garbled = client.get(f"/api/messages/{bob}", params={"token": alice_token, "before": "not a cursor"})
+
+    assert both.status_code == 400
+    assert garbled.status_code == 400
+
+
+def test_favorites_page_back(client, register):
+    _, token = register()
+    added = []
+    for i in range(5):
+        response = client.post("/api/favorites", params={"token": token}, json={"text": f"fav {i}"})
+        added.append(response.json()["id"])
+
+    favorites, pages = page_back(client, "/api/favorites", token, "favorites", 2)
+
+    assert [f["id"] for f in favorites] == added[::-1]
+    assert [len(p["favorites"]) for p in pages] == [2, 2, 1]
+
+
+def test_conversations_page_back(client, register, send):
+    alice, alice_token = register()
+    peers = [register()[0] for _ in range(5)]
+    for peer in peers:
+        send(alice_token, peer, "hi")
+    # Writing to the first peer again moves that conversation to the top
+    send(alice_token, peers[0], "again")
+
+    conversations, pages = page_back(client, "/api/conversations", alice_token, "conversations", 2)
+
+    assert [c["peer_id"] for c in conversations] == [peers[0]] + peers[:0:-1]
+    assert conversations[0]["last_message"]["text"] == "again"
+    assert [len(p["conversations"]) for p in pages] == [2, 2, 1]
@@ -0,0 +1,80 @@
+"""Presence: touches on authenticated requests and their batched last_online writes."""
+import threading
+import uuid
+
+from sqlalchemy import select
+
+import server
+
+
+def stored_last_online(client, user_id):
+    async def load():
+        async with server.AsyncSessionLocal() as db:
+            return await db.scalar(select(server.User.last_online).where(server.User.id == user_id))
+    return client.portal.call(load)
+
+
+def test_requests_touch_on_the_event_loop(client, register, monkeypatch):
+    user_id, token = register()
+    threads = []
+    touch = server.presence.touch
+    monkeypatch.setattr(server.presence, "touch", lambda user_id: (threads.append(threading.current_thread()), touch(user_id)))
+
+    assert client.get("/api/unread_counts", params={"token": token}).status_code == 200
+
+    # TestClient runs the app's event loop in its portal thread; a threadpool worker would show up here instead
+    assert threads and all(thread is threads[0] for thread in threads)
+    assert not threads[0].name.startswith("AnyIO worker thread")
+
+
+def test_flush_stores_last_online(client, register):
+    user_id, token = register()
+    client.portal.call(server.presence.flush)
+    before = stored_last_online(client, user_id)
+
+    client.get("/api/unread_counts", params={"token": token})
+    assert user_id in server.presence.pending
+    client.portal.call(server.presence.flush)
+
+    assert server.presence.pending == {}
+    assert stored_last_online(client, user_id) > before
+    presence = client.post("/api/presence", params={"token": token}, json={"user_ids": [user_id]}).json()["presence"]
+    assert presence[user_id]["online"] is True
+
+
+def test_flush_skips_unknown_users(client, register):
+    user_id, token = register()
+    ghost_token = server.create_access_token(str(uuid.uuid4()))
+
+    client.get("/api/unread_counts", params={"token": ghost_token})
+    client.get("/api/unread_counts", params={"token": token})
+    client.portal.call(server.presence.flush)
+
+    # The ghost neither fails the batch nor stays queued for another attempt
+    assert server.presence.pending == {}
+    assert server.presence.failures == 0
+    assert stored_last_online(client, user_id) is not None
+
+
+def test_run_survives_a_failing_flush(client, monkeypatch):
+    calls = []
+
+    async def flush():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("flush failed")
+        tracker.task.cancel()
+
+    tracker = server.PresenceTracker(interval=0, online_window=90)
+    monkeypatch.setattr(tracker, "flush", flush)
+
+    async def run():
+        tracker.start()
+        try:
+            await tracker.task
+        except server.asyncio.CancelledError:
+            pass
+
+    client.portal.call(run)
+
+    assert len(calls) == 2
@@ -0,0 +1,76 @@
+"""Cross-worker push through Redis pub/sub, including recovery from a dropped connection."""
+import asyncio
+
+import pytest
+
+import server
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class DroppedPubSub:
+    """A subscription whose connection is lost on the first read."""
+
+    async def listen(self):
+        raise ConnectionError("Connection closed by server.")
+        yield
+
+    async def reset(self):
+        pass
+
+
+def test_listener_resubscribes_after_a_drop(client):
+    async def scenario():
+        backend = server.RedisPubSub("redis://unused", min_backoff=0.01)
+        backend.client = fakeredis.aioredis.FakeRedis()
+        backend.pubsub = DroppedPubSub()
+        delivered = asyncio.Queue()
+
+        async def deliver(user_id, event):
+            await delivered.put((user_id, event))
+
+        backend.listener = asyncio.create_task(backend._listen(deliver))
+        try:
+            # Publish until the resubscribed listener picks one up
+            for _ in range(100):
+                await backend.publish("user-1", {"type": "message"})
+                try:
+                    return await asyncio.wait_for(delivered.get(), 0.05), backend.reconnects
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            await backend.stop()
+
+    received, reconnects = client.portal.call(scenario)
+
+    assert received == ("user-1", {"type": "message"})
+    assert reconnects == 1
+
+
+def test_backoff_grows_to_the_cap(client, monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 6:
+            raise asyncio.CancelledError
+
+    class Unreachable:
+        def pubsub(self):
+            raise ConnectionError("Connection refused")
+
+    async def scenario():
+        backend = server.RedisPubSub("redis://unused", min_backoff=1, max_backoff=8)
+        backend.client = Unreachable()
+        backend.pubsub = None
+        monkeypatch.setattr(server.asyncio, "sleep", sleep)
+        try:
+            await backend._listen(None)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            monkeypatch.undo()
+
+    client.portal.call(scenario)
+
+    assert delays == [1, 2, 4, 8, 8, 8]
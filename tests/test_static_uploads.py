@@ -0,0 +1,64 @@
+"""Serving /static/uploads: validators, byte ranges and precompressed siblings."""
+import hashlib
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def stored(client):
+    """A content-addressed text upload with its compressed siblings; returns (url, bytes)."""
+    data = os.urandom(16).hex().encode() + b"lorem ipsum dolor sit amet " * 200
+    name = hashlib.sha256(data).hexdigest() + ".txt"
+    path = os.path.join(server.UPLOAD_DIR, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    server.write_precompressed(path)
+    return server.upload_storage.url(name), data
+
+
+def test_content_addressed_upload_is_immutable(client, stored):
+    url, data = stored
+    response = client.get(url, headers={"Accept-Encoding": "identity"})
+
+    assert response.content == data
+    assert response.headers["cache-control"] == server.IMMUTABLE_CACHE_CONTROL
+    assert response.headers["etag"] == f'"{url.rsplit("/", 1)[1][:64]}"'
+
+    revalidated = client.get(url, headers={"Accept-Encoding": "identity", "If-None-Match": response.headers["etag"]})
+    assert revalidated.status_code == 304 and revalidated.content == b""
+
+
+@pytest.mark.parametrize("byte_range, start, end", [("bytes=10-19", 10, 19), ("bytes=-5", None, None), ("bytes=100-", 100, None)])
+def test_byte_ranges(client, stored, byte_range, start, end):
+    url, data = stored
+    expected = data[-5:] if start is None else data[start:None if end is None else end + 1]
+
+    response = client.get(url, headers={"Range": byte_range, "Accept-Encoding": "gzip"})
+
+    assert response.status_code == 206
+    assert response.content == expected
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-range"].endswith(f"/{len(data)}")
+
+
+def test_stale_if_range_sends_the_whole_file(client, stored):
+    url, data = stored
+
+    response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"stale"', "Accept-Encoding": "identity"})
+
+    assert response.status_code == 200 and response.content == data
+
+
+@pytest.mark.parametrize("encoding", ["br", "gzip"])
+def test_precompressed_sibling_is_served(client, stored, encoding):
+    url, data = stored
+
+    response = client.get(url, headers={"Accept-Encoding": encoding})
+
+    assert response.headers["content-encoding"] == encoding
+    assert response.headers["etag"].endswith(f'-{encoding}"')
+    assert response.content == data
+    assert client.get(url, headers={"Accept-Encoding": encoding, "If-None-Match": response.headers["etag"]}).status_code == 304
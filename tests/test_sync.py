@@ -0,0 +1,48 @@
+"""The /api/sync feed: messages past a seq cursor, including ones changed after they were read."""
+import server
+
+
+def sync(client, token, **params):
+    response = client.get("/api/sync", params={"token": token, **params})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_sync_pages_through_new_messages(client, register, send):
+    alice, alice_token = register()
+    bob, bob_token = register()
+    start = sync(client, bob_token)
+    assert start["messages"] == [] and not start["has_more"]
+
+    sent = [send(alice_token, bob, f"hello {i}") for i in range(5)]
+    first = sync(client, bob_token, since=start["cursor"], limit=3)
+    rest = sync(client, bob_token, since=first["cursor"], limit=3)
+
+    assert [m["id"] for m in first["messages"]] == sent[:3] and first["has_more"]
+    assert [m["id"] for m in rest["messages"]] == sent[3:] and not rest["has_more"]
+    assert sync(client, bob_token, since=rest["cursor"]) == {"messages": [], "cursor": rest["cursor"], "has_more": False}
+
+
+def test_sync_only_returns_own_messages(client, register, send):
+    alice, alice_token = register()
+    bob, _ = register()
+    _, carol_token = register()
+    start = sync(client, carol_token)["cursor"]
+
+    send(alice_token, bob, "not for carol")
+
+    assert sync(client, carol_token, since=start)["messages"] == []
+
+
+def test_read_messages_come_back_with_a_new_seq(client, register, send):
+    alice, alice_token = register()
+    bob, bob_token = register()
+    message_id = send(alice_token, bob, "read me")
+    cursor = sync(client, alice_token, since=0)["cursor"]
+
+    client.post(f"/api/messages/{alice}/read", params={"token": bob_token}, json={"message_id": message_id})
+    client.portal.call(server.read_receipts.flush)
+    changed = sync(client, alice_token, since=cursor)
+
+    assert [(m["id"], m["is_read"]) for m in changed["messages"]] == [(message_id, True)]
+    assert changed["cursor"] > cursor
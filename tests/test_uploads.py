@@ -0,0 +1,94 @@
+"""Resumable uploads: offsets, size limits, completion and cleanup."""
+import asyncio
+import hashlib
+import os
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def create(client, token, size, filename="notes.txt"):
+    return client.post("/api/uploads", params={"token": token}, json={"filename": filename, "size": size})
+
+
+def put(client, token, upload_id, offset, data):
+    return client.put(f"/api/uploads/{upload_id}", params={"token": token, "offset": offset}, content=data)
+
+
+def test_resumable_upload(client, register):
+    _, token = register()
+    data = os.urandom(10)
+    upload_id = create(client, token, len(data)).json()["upload_id"]
+
+    assert put(client, token, upload_id, 0, data[:4]).json()["offset"] == 4
+    # A retried chunk is refused with the offset to resume from
+    retried = put(client, token, upload_id, 0, data[:4])
+    assert retried.status_code == 409 and retried.json()["offset"] == 4
+    assert client.get(f"/api/uploads/{upload_id}", params={"token": token}).json()["offset"] == 4
+    early = client.post(f"/api/uploads/{upload_id}/complete", params={"token": token})
+    assert early.status_code == 409 and early.json()["offset"] == 4
+
+    assert put(client, token, upload_id, 4, data[4:]).json()["offset"] == 10
+    done = client.post(f"/api/uploads/{upload_id}/complete", params={"token": token})
+
+    assert done.status_code == 200
+    assert done.json()["sha256"] == hashlib.sha256(data).hexdigest()
+    assert client.get(done.json()["url"]).content == data
+    assert client.post(f"/api/uploads/{upload_id}/complete", params={"token": token}).status_code == 404
+    assert put(client, token, upload_id, 10, b"x").status_code == 404
+
+
+def test_sizes_are_enforced(client, register):
+    _, token = register()
+
+    assert create(client, token, server.MAX_UPLOAD_SIZE + 1).status_code == 413
+    upload_id = create(client, token, 5).json()["upload_id"]
+    assert put(client, token, upload_id, 0, b"too long").status_code == 413
+
+
+def test_sessions_are_private(client, register):
+    _, token = register()
+    _, other_token = register()
+    upload_id = create(client, token, 3).json()["upload_id"]
+
+    assert client.get(f"/api/uploads/{upload_id}", params={"token": other_token}).status_code == 404
+    assert put(client, other_token, upload_id, 0, b"abc").status_code == 404
+
+
+def test_concurrent_completes(client, register):
+    user_id, token = register()
+    upload_id = create(client, token, 3).json()["upload_id"]
+    put(client, token, upload_id, 0, b"abc")
+
+    async def complete_twice():
+        return await asyncio.gather(
+            server.complete_upload(upload_id, current_user_id=user_id),
+            server.complete_upload(upload_id, current_user_id=user_id),
+            return_exceptions=True,
+        )
+
+    first, second = client.portal.call(complete_twice)
+
+    assert first["size"] == 3
+    assert isinstance(second, HTTPException) and second.status_code == 404
+
+
+def test_open_sessions_are_capped(client, register, monkeypatch):
+    _, token = register()
+    monkeypatch.setattr(server, "UPLOAD_SESSIONS_PER_USER", 2)
+
+    assert [create(client, token, 1).status_code for _ in range(3)] == [200, 200, 429]
+
+
+@pytest.mark.parametrize("ttl, removed", [(3600, False), (0, True)])
+def test_sweeper_removes_abandoned_sessions(client, register, ttl, removed):
+    _, token = register()
+    upload_id = create(client, token, 3).json()["upload_id"]
+    put(client, token, upload_id, 0, b"a")
+
+    client.portal.call(server.PartialUploadSweeper(ttl=ttl, interval=3600).sweep)
+
+    status = client.get(f"/api/uploads/{upload_id}", params={"token": token}).status_code
+    assert status == (404 if removed else 200)